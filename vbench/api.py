@@ -3,5 +3,5 @@
 from vbench.benchmark import Benchmark
 from vbench.db import BenchmarkDB
 from vbench.runner import BenchmarkRunner
-from vbench.git import GitRepo
+from vbench.git import GitRepo, BuildCache, CompilerCache
 from vbench.utils import collect_benchmarks, verify_benchmarks
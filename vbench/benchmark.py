@@ -2,6 +2,7 @@
 
 from cStringIO import StringIO
 
+import cPickle as pickle
 import cProfile
 try:
     import pstats
@@ -11,9 +12,15 @@ except ImportError:
     # from a local copy
     import _pstats as pstats
 
+from collections import OrderedDict
+
 import gc
 import hashlib
+import os
 import re
+import select
+import signal
+import sys
 import time
 import traceback
 import inspect
@@ -25,12 +32,15 @@ class Benchmark(object):
 
     def __init__(self, code, setup, ncalls=None, repeat=3, cleanup=None,
                  name=None, module_name=None, description=None, start_date=None,
-                 logy=False):
+                 logy=False, target_precision=None, time_budget=10.0):
         self.code = code
         self.setup = setup
         self.cleanup = cleanup or ''
         self.ncalls = ncalls
         self.repeat = repeat
+        # adaptive repetition (see magic_timeit)
+        self.target_precision = target_precision
+        self.time_budget = time_budget
 
         if name is None:
             try:
@@ -48,7 +58,10 @@ class Benchmark(object):
     def __repr__(self):
         return "Benchmark('%s')" % self.name
 
-    def _setup(self):
+    def _setup(self, shared_setups=None):
+        # benchmarks with a cleanup might leave shared state unusable
+        if shared_setups is not None and not self.cleanup.strip():
+            return shared_setups.namespace(self.setup)
         ns = globals().copy()
         exec self.setup in ns
         return ns
@@ -80,7 +93,8 @@ class Benchmark(object):
         db = BenchmarkDB.get_instance(db_path)
         return db.get_benchmark_results(self.checksum)
 
-    def run(self, ncalls=None, repeat=None):
+    def run(self, ncalls=None, repeat=None, adaptive=True, loops_hint=None,
+            shared_setups=None):
         """
         Parameters
         ----------
@@ -88,15 +102,28 @@ class Benchmark(object):
           If specified and non-0, would override specified in constructor ncalls
         repeat: int, optional
           If specified and non-0, would override specified in constructor repeat
+        adaptive: bool, optional
+          If False, target_precision specified in constructor is ignored
+          and exactly `repeat` repeats are done
+        loops_hint: int, optional
+          Number of loops to try first instead of calibrating (if ncalls
+          is not specified)
+        shared_setups: SharedSetups, optional
+          If specified, namespace of an identical setup executed before is
+          reused (unless the benchmark has a cleanup)
         """
         ns = None
         try:
             stage = 'setup'
-            ns = self._setup()
+            ns = self._setup(shared_setups)
 
             stage = 'benchmark'
             result = magic_timeit(ns, self.code, ncalls=ncalls or self.ncalls,
-                                  repeat=repeat or self.repeat, force_ms=True)
+                                  repeat=repeat or self.repeat, force_ms=True,
+                                  target_precision=adaptive and
+                                                   self.target_precision,
+                                  time_budget=self.time_budget,
+                                  loops_hint=loops_hint)
             result['succeeded'] = True
         except:
             buf = StringIO()
@@ -152,11 +179,12 @@ class Benchmark(object):
 
         return output
 
-    def plot(self, db_path, label='time', ax=None, title=True):
+    def plot(self, db_path, label='time', ax=None, title=True, results=None):
         import matplotlib.pyplot as plt
         from matplotlib.dates import MonthLocator, DateFormatter
 
-        results = self.get_results(db_path)
+        if results is None:
+            results = self.get_results(db_path)
 
         if ax is None:
             fig = plt.figure()
@@ -292,6 +320,29 @@ def indent(string, spaces=4):
     return '\n'.join([dent + x for x in string.split('\n')])
 
 
+class SharedSetups(object):
+    """Namespaces of executed setups, for reuse by benchmarks with identical setup
+
+    Every user gets a shallow copy of the namespace.  Only `maxsize` most
+    recently used setups are kept, so benchmarks should be ordered to
+    have identical setups next to each other.
+    """
+
+    def __init__(self, maxsize=1):
+        self.maxsize = maxsize
+        self._namespaces = OrderedDict()
+
+    def namespace(self, setup):
+        ns = self._namespaces.pop(setup, None)
+        if ns is None:
+            ns = globals().copy()
+            exec setup in ns
+        self._namespaces[setup] = ns
+        while len(self._namespaces) > self.maxsize:
+            self._namespaces.popitem(last=False)
+        return ns.copy()
+
+
 class BenchmarkSuite(list):
     """Basically a list, but the special type is needed for discovery"""
     @property
@@ -302,9 +353,21 @@ class BenchmarkSuite(list):
 # Modified from IPython project, http://ipython.org
 
 
-def magic_timeit(ns, stmt, ncalls=None, repeat=3, force_ms=False):
+def magic_timeit(ns, stmt, ncalls=None, repeat=3, force_ms=False,
+                 target_precision=None, time_budget=None, loops_hint=None):
     """Time execution of a Python statement or expression
 
+    If ncalls is None, loops_hint (e.g. number of loops chosen for a
+    previous revision) is used as long as a single repeat with it takes
+    reasonable time, avoiding the calibration.  Whether calibration was
+    done is returned as 'calibrated'.
+
+    If target_precision is given, repeats continue beyond `repeat` until
+    the relative half-width of the 95% confidence interval of the mean
+    drops below target_precision (e.g. 0.01 for 1%) or time_budget
+    (seconds) is exhausted, but in any case no more than _MAX_REPEAT
+    repeats are done.  Achieved precision is returned as 'precision'.
+
     Usage:\\
       %timeit [-n<N> -r<R> [-t|-c]] statement
 
@@ -369,8 +432,9 @@ def magic_timeit(ns, stmt, ncalls=None, repeat=3, force_ms=False):
     # but is there a better way to achieve that the code stmt has access
     # to the shell namespace?
 
+    # init is present in the template only in later 2.7 releases
     src = timeit.template % {'stmt': timeit.reindent(stmt, 8),
-                             'setup': "pass"}
+                             'setup': "pass", 'init': ''}
     # Track compilation time so it can be reported if too long
     # Minimum time above which compilation time will be reported
     code = compile(src, "<magic-timeit>", "exec")
@@ -378,17 +442,28 @@ def magic_timeit(ns, stmt, ncalls=None, repeat=3, force_ms=False):
     exec code in ns
     timer.inner = ns["inner"]
 
-    if ncalls is None:
+    calibrated = False
+    if ncalls is not None:
+        number = ncalls
+    elif loops_hint and _loops_hint_fits(timer.timeit(loops_hint), loops_hint):
+        number = loops_hint
+    else:
         # determine number so that 0.2 <= total time < 2.0
+        calibrated = True
         number = 1
         for _ in range(1, 10):
             if timer.timeit(number) >= 0.1:
                 break
             number *= 10
-    else:
-        number = ncalls
 
-    best = min(timer.repeat(repeat, number)) / number
+    start = time.time()
+    timings = timer.repeat(repeat, number)
+    if target_precision:
+        while (relative_ci_halfwidth(timings) > target_precision
+               and len(timings) < _MAX_REPEAT
+               and (not time_budget or time.time() - start < time_budget)):
+            timings.append(timer.timeit(number))
+    best = min(timings) / number
 
     if force_ms:
         order = 1
@@ -401,11 +476,150 @@ def magic_timeit(ns, stmt, ncalls=None, repeat=3, force_ms=False):
             order = 3
 
     return {'loops': number,
-            'repeat': repeat,
+            'repeat': len(timings),
             'timing': best * scaling[order],
+            'samples': [t / number * scaling[order] for t in timings],
+            'precision': relative_ci_halfwidth(timings),
+            'calibrated': calibrated,
             'units': units[order]}
 
 
+# upper bound on the number of repeats while aiming for target_precision,
+# so noisy benchmarks terminate even without a time_budget
+_MAX_REPEAT = 1000
+
+
+# range of the time (in seconds) of a single repeat within which a
+# previously calibrated number of loops is still considered adequate
+_CALIBRATION_BAND = (0.05, 2.0)
+
+
+def _loops_hint_fits(elapsed, loops):
+    lo, hi = _CALIBRATION_BAND
+    # a single loop can't get any shorter
+    return elapsed >= lo and (elapsed < hi or loops == 1)
+
+
+# two-sided 95% quantiles of Student's t distribution for 1..30 degrees
+# of freedom
+_T_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262,
+         2.228, 2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101,
+         2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052,
+         2.048, 2.045, 2.042]
+
+
+def relative_ci_halfwidth(samples):
+    """Half-width of the 95% confidence interval of the mean relative to it
+
+    Returns inf if it could not be estimated (less than 2 samples)
+    """
+    n = len(samples)
+    if n < 2:
+        return float('inf')
+    mean = sum(samples) / float(n)
+    if mean <= 0:
+        return float('inf')
+    var = sum((x - mean) ** 2 for x in samples) / (n - 1)
+    t = _T_95[n - 2] if n - 2 < len(_T_95) else 1.96
+    return t * (var / n) ** 0.5 / mean
+
+
+def run_isolated(benchmark, timeout=None, memory_limit=None, **kwargs):
+    """Run benchmark in a forked child process
+
+    Since the child is forked from the current process, all the modules
+    already imported here come for free.
+
+    Parameters
+    ----------
+    timeout : float, optional
+      Wall-clock time (in seconds) after which the child gets killed and
+      result is reported with 'stage': 'timeout'
+    memory_limit : int, optional
+      Limit (in bytes) for the address space of the child (RLIMIT_AS).
+      Running out of it (MemoryError or the child getting SIGKILLed) is
+      reported with 'stage': 'oom'
+    **kwargs
+      Passed to `Benchmark.run`.  Setups shared through `shared_setups`
+      are executed here before forking only if neither timeout nor
+      memory_limit is given, since those limits apply to the child only
+    """
+    import resource
+    shared_setups = kwargs.get('shared_setups')
+    if (shared_setups is not None and not benchmark.cleanup.strip()
+        and not timeout and not memory_limit):
+        # execute setup here, so the children get it through the fork
+        try:
+            shared_setups.namespace(benchmark.setup)
+        except Exception:
+            # child will fail and report it
+            pass
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # child
+        os.close(rfd)
+        try:
+            if memory_limit:
+                resource.setrlimit(resource.RLIMIT_AS,
+                                   (memory_limit, memory_limit))
+            result = benchmark.run(**kwargs)
+            if (memory_limit and not result['succeeded']
+                and 'MemoryError' in result.get('traceback', '')):
+                result['stage'] = 'oom'
+            data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+            while data:
+                data = data[os.write(wfd, data):]
+            sys.stdout.flush()
+        finally:
+            os._exit(0)
+
+    os.close(wfd)
+    chunks = []
+    timed_out = False
+    deadline = time.time() + timeout if timeout else None
+    try:
+        while True:
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    timed_out = True
+                    break
+            ready, _, _ = select.select([rfd], [], [], wait)
+            if not ready:
+                timed_out = True
+                break
+            chunk = os.read(rfd, 1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(rfd)
+
+    if timed_out:
+        os.kill(pid, signal.SIGKILL)
+    _, status = os.waitpid(pid, 0)
+
+    if timed_out:
+        return {'succeeded': False,
+                'stage': 'timeout',
+                'traceback': 'Timed out after %s seconds' % timeout}
+    if chunks:
+        return pickle.loads(''.join(chunks))
+
+    if os.WIFSIGNALED(status):
+        reason = 'killed by signal %d' % os.WTERMSIG(status)
+    else:
+        reason = 'exited with code %d' % os.WEXITSTATUS(status)
+    # running out of memory might get the process killed instead of
+    # raising MemoryError, but other signals (SIGSEGV, ...) are crashes
+    killed = os.WIFSIGNALED(status) and os.WTERMSIG(status) == signal.SIGKILL
+    return {'succeeded': False,
+            'stage': 'oom' if memory_limit and killed else 'crash',
+            'traceback': 'Benchmark process %s' % reason}
+
+
 def gather_benchmarks(ns):
     benchmarks = []
     for v in ns.values():
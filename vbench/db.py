@@ -1,24 +1,62 @@
-from pandas import DataFrame
+import json
+import os
+import struct
+import time
 
-from sqlalchemy import Table, Column, MetaData, create_engine, ForeignKey
+from collections import OrderedDict
+
+import numpy as np
+from pandas import DataFrame, Period, Series, concat, to_datetime
+
+from sqlalchemy import Table, Column, Index, MetaData, create_engine, \
+     ForeignKey, event
 from sqlalchemy import types as sqltypes
 from sqlalchemy import sql
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import reflection
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError, IntegrityError, OperationalError
 
 import logging
 log = logging.getLogger('vb.db')
 
 class BenchmarkDB(object):
     """
-    Persist vbench results in a sqlite3 database
+    Persist vbench results in a sqlite3 (or any SQLAlchemy supported)
+    database
+
+    dbpath is either a path of a sqlite database or a database URL, e.g.
+    postgresql://host/vbench to share a single store among several
+    benchmarking hosts.  Results are written as upserts, replacing an
+    existing result of the same benchmark and revision, and writes failing
+    due to concurrent writers are retried (up to write_retries times).
+
+    Results of the most frequent queries are cached (up to cache_size of
+    them) until modified through this instance, so writes from other
+    hosts are not seen by an instance which already read the results.
+    Returned objects should not be modified in place.
     """
 
-    def __init__(self, dbpath):
-        log.info("Initializing DB at %s" % dbpath)
+    def __init__(self, dbpath, cache_size=128, busy_timeout=30,
+                 write_retries=5):
+        url = make_url(dbpath if '://' in dbpath else 'sqlite:///' + dbpath)
+        log.info("Initializing DB at %r" % url)
         self.dbpath = dbpath
+        self.write_retries = write_retries
+        self._cache = _QueryCache(cache_size)
 
-        self._engine = create_engine('sqlite:///%s' % dbpath)
+        if url.drivername.startswith('sqlite'):
+            # wait for other writers to release the lock (in seconds)
+            self._engine = create_engine(
+                url, connect_args={'timeout': busy_timeout})
+            event.listen(self._engine, 'connect', _set_sqlite_pragmas)
+        else:
+            # connections taken from the pool once the previous one was
+            # lost (see conn) are checked to be alive
+            self._engine = create_engine(url, pool_pre_ping=True)
         self._metadata = MetaData()
         self._metadata.bind = self._engine
+        self._conn = None
 
         self._benchmarks = Table('benchmarks', self._metadata,
             Column('checksum', sqltypes.String(32), primary_key=True),
@@ -33,37 +71,111 @@ class BenchmarkDB(object):
             Column('ncalls', sqltypes.String(50)),
             Column('timing', sqltypes.Float),
             Column('traceback', sqltypes.Text),
+            # revision the result was copied from, if the benchmarked
+            # sources did not change since then
+            Column('carried_from', sqltypes.String(50)),
+        )
+
+        # all the per-repeat timings behind results' timing
+        self._samples = Table('samples', self._metadata,
+            Column('checksum', sqltypes.String(32),
+                   ForeignKey('benchmarks.checksum'), primary_key=True),
+            Column('revision', sqltypes.String(50), primary_key=True),
+            Column('loops', sqltypes.Integer),
+            Column('samples', sqltypes.LargeBinary),
         )
 
         self._blacklist = Table('blacklist', self._metadata,
             Column('revision', sqltypes.String(50), primary_key=True)
         )
 
+        # old results rolled up by downsample(), one row per benchmark and
+        # period (day, week, ...) starting at timestamp
+        self._aggregates = Table('aggregates', self._metadata,
+            Column('checksum', sqltypes.String(32),
+                   ForeignKey('benchmarks.checksum'), primary_key=True),
+            Column('timestamp', sqltypes.DateTime, primary_key=True),
+            Column('period', sqltypes.String(10), nullable=False),
+            # last revision of the period
+            Column('revision', sqltypes.String(50), nullable=False),
+            Column('timing', sqltypes.Float),
+            Column('median', sqltypes.Float),
+            Column('count', sqltypes.Integer),
+        )
+
+        # primary keys cover lookups by checksum, but not by revision or
+        # ordered by time
+        Index('ix_results_revision', self._results.c.revision)
+        Index('ix_results_checksum_timestamp',
+              self._results.c.checksum, self._results.c.timestamp)
+        Index('ix_samples_revision', self._samples.c.revision)
+
         self._ensure_tables_created()
 
     _instances = {}
 
     @classmethod
     def get_instance(cls, dbpath):
+        """Return shared instance for dbpath, ColumnarDB for an export"""
         if dbpath not in cls._instances:
-            cls._instances[dbpath] = BenchmarkDB(dbpath)
+            if ColumnarDB.is_columnar(dbpath):
+                cls._instances[dbpath] = ColumnarDB(dbpath)
+            else:
+                cls._instances[dbpath] = BenchmarkDB(dbpath)
         return cls._instances[dbpath]
 
     def _ensure_tables_created(self):
         log.debug("Ensuring DB tables are created")
         self._benchmarks.create(self._engine, checkfirst=True)
         self._results.create(self._engine, checkfirst=True)
+        self._samples.create(self._engine, checkfirst=True)
         self._blacklist.create(self._engine, checkfirst=True)
+        self._aggregates.create(self._engine, checkfirst=True)
+        self._upgrade_tables()
+
+    def _upgrade_tables(self):
+        """Add columns and indexes introduced after the database was created"""
+        inspector = reflection.Inspector.from_engine(self._engine)
+        for table in (self._benchmarks, self._results, self._samples,
+                      self._blacklist, self._aggregates):
+            existing = set(x['name'] for x in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                log.info("Adding column %s to table %s"
+                         % (column.name, table.name))
+                self.conn.execute('ALTER TABLE %s ADD COLUMN %s %s'
+                                  % (table.name, column.name,
+                                     column.type.compile(self._engine.dialect)))
+
+            existing = set(x['name'] for x in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                log.info("Creating index %s on table %s"
+                         % (index.name, table.name))
+                index.create(self.conn)
 
     def update_name(self, benchmark):
         """
         benchmarks : list
         """
+        self.update_names([benchmark])
+
+    def update_names(self, benchmarks):
+        """Update names of already stored benchmarks in a single transaction
+        """
+        if not benchmarks:
+            return
         table = self._benchmarks
         stmt = (table.update().
-                where(table.c.checksum == benchmark.checksum).
-                values(checksum=benchmark.checksum))
-        self.conn.execute(stmt)
+                where(table.c.checksum == sql.bindparam('_checksum')).
+                values(name=sql.bindparam('_name')))
+        with self.conn.begin():
+            self.conn.execute(stmt, [{'_checksum': bm.checksum,
+                                      '_name': bm.name}
+                                     for bm in benchmarks])
+        self._cache.invalidate('benchmarks')
 
     def restrict_to_benchmarks(self, benchmarks):
         """
@@ -80,19 +192,61 @@ class BenchmarkDB(object):
             log.info('Deleting %s\n%s' % (chksum, ex_benchmarks.xs(chksum)))
             stmt = t.delete().where(t.c.checksum == chksum)
             self.conn.execute(stmt)
+        self._cache.invalidate('benchmarks')
 
     @property
     def conn(self):
-        return self._engine.connect()
+        # a single connection is reused for all the operations, until it
+        # gets invalidated by losing connection to the server (restarted,
+        # closed an idle connection, ...)
+        if self._conn is not None and self._conn.invalidated:
+            log.warn("Lost connection to the DB, reconnecting")
+            self.close()
+        if self._conn is None:
+            self._conn = self._engine.connect()
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _transaction(self, write):
+        """Call write(conn) in a transaction, retrying it if it failed due
+        to a concurrent writer or a lost connection"""
+        for attempt in range(self.write_retries + 1):
+            try:
+                with self.conn.begin():
+                    write(self.conn)
+                return
+            except DBAPIError, e:
+                # lost connection gets replaced by conn on the next attempt
+                retry = e.connection_invalidated or (
+                    isinstance(e, (OperationalError, IntegrityError))
+                    and _is_transient(e))
+                if attempt == self.write_retries or not retry:
+                    raise
+                delay = 0.1 * 2 ** attempt
+                log.warn("Write failed (%s), retrying in %.1f sec"
+                         % (e.orig, delay))
+                time.sleep(delay)
 
     def write_benchmark(self, bm, overwrite=False):
         """
 
         """
-        ins = self._benchmarks.insert()
-        ins = ins.values(name=bm.name, checksum=bm.checksum,
-                         description=bm.description)
-        self.conn.execute(ins)  # XXX: return the result?
+        self.write_benchmarks([bm])
+
+    def write_benchmarks(self, benchmarks):
+        """Store new benchmarks in a single transaction
+        """
+        if not benchmarks:
+            return
+        rows = [dict(name=bm.name, checksum=bm.checksum,
+                     description=bm.description)
+                for bm in benchmarks]
+        self._transaction(lambda conn: _upsert(conn, self._benchmarks, rows))
+        self._cache.invalidate('benchmarks')
 
     def delete_benchmark(self, checksum):
         """
@@ -101,15 +255,59 @@ class BenchmarkDB(object):
         pass
 
     def write_result(self, checksum, revision, timestamp, ncalls,
-                     timing, traceback=None, overwrite=False):
+                     timing, traceback=None, overwrite=False,
+                     carried_from=None, samples=None):
+        """
+
+        samples : list of float, optional
+          timings of all the repeats (timing being the best of them)
         """
+        self.write_results([dict(checksum=checksum, revision=revision,
+                                 timestamp=timestamp, ncalls=ncalls,
+                                 timing=timing, traceback=traceback,
+                                 carried_from=carried_from,
+                                 samples=samples)])
+
+    def write_results(self, rows):
+        """Store results in a single transaction
+
+        Existing results (and their samples) of the same benchmark and
+        revision are replaced.
 
+        rows : list of dict
+          with keys as arguments of `write_result`.  Missing ones
+          default to None
         """
-        ins = self._results.insert()
-        ins = ins.values(checksum=checksum, revision=revision,
-                         timestamp=timestamp,
-                         ncalls=ncalls, timing=timing, traceback=traceback)
-        self.conn.execute(ins)  # XXX: return the result?
+        results, samples, no_samples = [], [], []
+        for row in rows:
+            results.append(dict((c, row.get(c)) for c in
+                                ('checksum', 'revision', 'timestamp',
+                                 'ncalls', 'timing', 'traceback',
+                                 'carried_from')))
+            if row.get('samples'):
+                samples.append(dict(checksum=row['checksum'],
+                                    revision=row['revision'],
+                                    loops=row.get('ncalls'),
+                                    samples=_pack_samples(row['samples'])))
+            else:
+                no_samples.append(dict(checksum=row['checksum'],
+                                       revision=row['revision']))
+        if not results:
+            return
+
+        def write(conn):
+            _upsert(conn, self._results, results)
+            if samples:
+                _upsert(conn, self._samples, samples)
+            if no_samples:
+                # do not leave samples of a replaced result behind
+                _delete_keys(conn, self._samples, no_samples)
+        self._transaction(write)
+        self._cache.invalidate('results:*',
+                               *set(['results:%s' % row['checksum']
+                                     for row in results]
+                                    + ['rev:%s' % row['revision']
+                                       for row in results]))
 
     def delete_result(self, checksum, revision):
         """
@@ -122,52 +320,750 @@ class BenchmarkDB(object):
         ins = tab.delete()
         ins = ins.where(tab.c.timing == None)
         self.conn.execute(ins)
+        self._cache.invalidate('results')
 
     def get_benchmarks(self):
-        stmt = sql.select([self._benchmarks])
-        result = self.conn.execute(stmt)
-        return _sqa_to_frame(result).set_index('checksum')
+        def query():
+            stmt = sql.select([self._benchmarks])
+            result = self.conn.execute(stmt)
+            return _sqa_to_frame(result).set_index('checksum')
+        return self._cache.get(('benchmarks',), ['benchmarks'], query).copy()
 
-    def get_rev_results(self, rev):
+    def get_latest_ncalls(self):
+        """Return dict of checksum: ncalls of the latest successful result"""
         tab = self._results
+        latest = sql.select([tab.c.checksum,
+                             sql.func.max(tab.c.timestamp).label('timestamp')],
+                            tab.c.timing != None).group_by(tab.c.checksum)
+        latest = latest.alias('latest')
+        stmt = sql.select([tab.c.checksum, tab.c.ncalls],
+                          sql.and_(tab.c.ncalls != None,
+                                   tab.c.checksum == latest.c.checksum,
+                                   tab.c.timestamp == latest.c.timestamp))
+        return dict((row.checksum, int(row.ncalls))
+                    for row in self.conn.execute(stmt))
+
+    def get_latest_results(self, before):
+        """Return dict of checksum: row of the latest successful result
+        with timestamp earlier than `before`"""
+        tab = self._results
+        successful = sql.and_(tab.c.timing != None, tab.c.timestamp < before)
+        latest = sql.select([tab.c.checksum,
+                             sql.func.max(tab.c.timestamp).label('timestamp')],
+                            successful).group_by(tab.c.checksum)
+        latest = latest.alias('latest')
         stmt = sql.select([tab],
-                          sql.and_(tab.c.revision == rev))
-        results = list(self.conn.execute(stmt))
-        return dict((v.checksum, v) for v in results)
+                          sql.and_(tab.c.timing != None,
+                                   tab.c.checksum == latest.c.checksum,
+                                   tab.c.timestamp == latest.c.timestamp))
+        return dict((row.checksum, row) for row in self.conn.execute(stmt))
+
+    def get_rev_results(self, rev):
+        def query():
+            tab = self._results
+            stmt = sql.select([tab],
+                              sql.and_(tab.c.revision == rev))
+            results = list(self.conn.execute(stmt))
+            return dict((v.checksum, v) for v in results)
+        return dict(self._cache.get(('rev_results', rev),
+                                    ['results', 'rev:%s' % rev], query))
 
     def delete_rev_results(self, rev):
-        tab = self._results
-        stmt = tab.delete().where(tab.c.revision == rev)
-        self.conn.execute(stmt)
+        for tab in (self._results, self._samples):
+            stmt = tab.delete().where(tab.c.revision == rev)
+            self.conn.execute(stmt)
+        self._cache.invalidate('results')
 
     def add_rev_blacklist(self, rev):
         """
         Don't try running this revision again
         """
-        stmt = self._blacklist.insert().values(revision=rev)
-        self.conn.execute(stmt)
+        self._transaction(lambda conn: _upsert(conn, self._blacklist,
+                                               [dict(revision=rev)]))
+        self._cache.invalidate('blacklist')
 
     def get_rev_blacklist(self):
-        stmt = self._blacklist.select()
-        return [x['revision'] for x in self.conn.execute(stmt)]
+        def query():
+            stmt = self._blacklist.select()
+            return [x['revision'] for x in self.conn.execute(stmt)]
+        return list(self._cache.get(('blacklist',), ['blacklist'], query))
 
     def clear_blacklist(self):
         stmt = self._blacklist.delete()
         self.conn.execute(stmt)
+        self._cache.invalidate('blacklist')
 
-    def get_benchmark_results(self, checksum):
+    def get_benchmark_results(self, checksum, stats=False, aggregated=True):
         """
 
+        stats : boolean
+          add mean, median, std and min (and count of) the stored samples
+          for every revision
+        aggregated : boolean
+          include the history rolled up by `downsample`, a row per period
+          with the minimal timing and the last revision of the period.
+          Its period, timing_median and nresults columns are only present
+          if there is any
         """
+        def query():
+            tab = self._results
+            stmt = sql.select([tab.c.timestamp, tab.c.revision, tab.c.ncalls,
+                               tab.c.timing, tab.c.traceback,
+                               tab.c.carried_from],
+                              sql.and_(tab.c.checksum == checksum))
+            results = self.conn.execute(stmt)
+
+            df = _sqa_to_frame(results).set_index('timestamp')
+            if stats:
+                df = df.join(self.get_samples_stats(checksum), on='revision')
+            if aggregated:
+                agg = self._get_aggregates(checksum)
+                if len(agg):
+                    df = concat([agg, df], sort=False)
+            return df.sort_index()
+        return self._cache.get(('benchmark_results', checksum, stats,
+                                aggregated),
+                               ['results', 'results:%s' % checksum],
+                               query).copy()
+
+    def _get_aggregates(self, checksum):
+        tab = self._aggregates
+        stmt = sql.select([tab.c.timestamp, tab.c.revision, tab.c.timing,
+                           tab.c.period, tab.c.median, tab.c.count],
+                          tab.c.checksum == checksum)
+        df = _sqa_to_frame(self.conn.execute(stmt)).set_index('timestamp')
+        return df.rename(columns={'median': 'timing_median',
+                                  'count': 'nresults'})
+
+    def get_downsampled_until(self):
+        """Return time before which results were rolled up by `downsample`
+        """
+        tab = self._aggregates
+        stmt = sql.select([tab.c.timestamp, tab.c.period]).order_by(
+            tab.c.timestamp.desc()).limit(1)
+        row = self.conn.execute(stmt).first()
+        if row is None:
+            return None
+        next_period = Period(row.timestamp, row.period) + 1
+        return next_period.start_time.to_pydatetime()
+
+    def downsample(self, before, freq='W'):
+        """Roll up results older than before into per-period aggregates
+
+        For every benchmark and period only the minimum, median and count
+        of the successful timings are kept, the individual results (and
+        their samples) are deleted.  Only whole periods are rolled up.
+
+        Parameters
+        ----------
+        before : datetime
+        freq : string
+          pandas frequency of the periods, e.g. 'D' (days) or 'W' (weeks)
+
+        Returns
+        -------
+        number of rolled up results
+        """
+        before = Period(before, freq).start_time.to_pydatetime()
+        tab = self._results
+        stmt = sql.select([tab.c.checksum, tab.c.revision, tab.c.timestamp,
+                           tab.c.timing], tab.c.timestamp < before)
+        df = _sqa_to_frame(self.conn.execute(stmt))
+        if not len(df):
+            return 0
+
+        df['timestamp'] = to_datetime(df['timestamp'])
+        df['period'] = df['timestamp'].dt.to_period(freq).dt.start_time
+        # the same revision for a period across benchmarks, so reports
+        # line them up
+        revisions = df.sort_values('timestamp').groupby('period')[
+            'revision'].last()
+        # NULL timings (failures) make it an object column
+        ok = df[df['timing'].notnull()].astype({'timing': float})
+        agg = ok.groupby(['checksum', 'period'])['timing'].agg(
+            ['min', 'median', 'count'])
+
+        atab = self._aggregates
+        stmt = sql.select([atab], atab.c.timestamp < before)
+        existing = dict(((row.checksum, row.timestamp), row)
+                        for row in self.conn.execute(stmt))
+        rows = []
+        for (checksum, period), x in agg.iterrows():
+            period = period.to_pydatetime()
+            timing, median, count = x['min'], x['median'], int(x['count'])
+            prev = existing.get((checksum, period))
+            if prev is not None and prev.count:
+                # results added to an already rolled up period, the median
+                # can only be approximated
+                median = ((median * count + prev.median * prev.count)
+                          / (count + prev.count))
+                timing = min(timing, prev.timing)
+                count += prev.count
+            rows.append(dict(checksum=checksum, timestamp=period,
+                             period=freq,
+                             revision=revisions[period],
+                             timing=timing, median=median, count=count))
+
+        keys = [dict(checksum=row.checksum, revision=row.revision)
+                for row in df.itertuples()]
+
+        def write(conn):
+            if rows:
+                _upsert(conn, atab, rows)
+            _delete_keys(conn, self._samples, keys)
+            _delete_keys(conn, self._results, keys)
+        self._transaction(write)
+        self._cache.invalidate('results')
+        log.info("Rolled up %d results before %s into %d aggregates"
+                 % (len(keys), before, len(rows)))
+        return len(keys)
+
+    def get_all_results(self, checksums=None, since=None):
+        """Fetch results of all (or selected) benchmarks with a single query
+
+        Parameters
+        ----------
+        checksums : list, optional
+          restrict to these benchmarks
+        since : datetime, optional
+          restrict to revisions with timestamp not earlier than that
+
+        Returns
+        -------
+        AllResults
+        """
+        if checksums is not None:
+            checksums = tuple(sorted(checksums))
+        return self._cache.get(('all_results', checksums, since),
+                               ['results', 'results:*'],
+                               lambda: self._get_all_results(checksums, since))
+
+    def _get_all_results(self, checksums, since):
         tab = self._results
-        stmt = sql.select([tab.c.timestamp, tab.c.revision, tab.c.ncalls,
+        conditions = []
+        if checksums is not None:
+            conditions.append(tab.c.checksum.in_(list(checksums)))
+        if since is not None:
+            conditions.append(tab.c.timestamp >= since)
+        stmt = sql.select([tab.c.checksum, tab.c.revision, tab.c.timestamp,
                            tab.c.timing, tab.c.traceback],
-                          sql.and_(tab.c.checksum == checksum))
-        results = self.conn.execute(stmt)
+                          sql.and_(*conditions) if conditions else None)
+        df = _sqa_to_frame(self.conn.execute(stmt))
+
+        atab = self._aggregates
+        conditions = []
+        if checksums is not None:
+            conditions.append(atab.c.checksum.in_(list(checksums)))
+        if since is not None:
+            conditions.append(atab.c.timestamp >= since)
+        stmt = sql.select([atab.c.checksum, atab.c.revision, atab.c.timestamp,
+                           atab.c.timing],
+                          sql.and_(*conditions) if conditions else None)
+        agg = _sqa_to_frame(self.conn.execute(stmt))
+        if len(agg):
+            agg['traceback'] = None
+            df = concat([agg, df], sort=False)
+        return AllResults.from_frame(df)
+
+    def get_samples(self, checksum):
+        """Return dict of revision: array of all samples stored for it"""
+        tab = self._samples
+        stmt = sql.select([tab.c.revision, tab.c.samples],
+                          tab.c.checksum == checksum)
+        return dict((row.revision, _unpack_samples(row.samples))
+                    for row in self.conn.execute(stmt))
+
+    def get_samples_stats(self, checksum):
+        """Return frame of statistics of samples per revision"""
+        return _samples_stats(self.get_samples(checksum))
+
+    def export_columnar(self, path):
+        """Export the whole database to directory path (see `ColumnarDB`)
+
+        Results are stored one column per .npy file, sorted by benchmark
+        and timestamp, so they can be memory-mapped when read back.  So is
+        the history rolled up by `downsample`, in aggregates_* columns.
+        """
+        tab = self._results
+        stmt = sql.select([tab]).order_by(tab.c.checksum, tab.c.timestamp)
+        rows = self.conn.execute(stmt).fetchall()
+
+        atab = self._aggregates
+        stmt = sql.select([atab]).order_by(atab.c.checksum, atab.c.timestamp)
+        aggregates = self.conn.execute(stmt).fetchall()
+
+        stab = self._samples
+        samples = dict(((row.checksum, row.revision),
+                        _unpack_samples(row.samples))
+                       for row in self.conn.execute(sql.select([stab])))
+
+        benchmarks = [dict(checksum=row.checksum, name=row.name,
+                           description=row.description)
+                      for row in self.conn.execute(
+                          sql.select([self._benchmarks]))]
+        meta = dict(format=ColumnarDB.FORMAT,
+                    benchmarks=benchmarks,
+                    blacklist=self.get_rev_blacklist())
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        def save(name, values, dtype=None):
+            np.save(os.path.join(path, name + '.npy'),
+                    np.array(values, dtype=dtype))
+
+        def strings(values):
+            # fixed width bytes, '' for NULL, can be memory-mapped
+            return np.array([_to_bytes(v or '') for v in values], dtype='S')
+
+        def floats(values):
+            return [np.nan if v is None else v for v in values]
+
+        save('checksum', strings(r.checksum for r in rows))
+        save('revision', strings(r.revision for r in rows))
+        save('ncalls', strings(r.ncalls for r in rows))
+        save('carried_from', strings(r.carried_from for r in rows))
+        save('timestamp', [r.timestamp for r in rows], 'M8[us]')
+        save('timing', floats(r.timing for r in rows), 'f8')
+
+        # variable length columns are concatenated with a length per row,
+        # -1 for NULL
+        tracebacks = [None if r.traceback is None
+                      else r.traceback.encode('utf-8') for r in rows]
+        save('traceback_len', [-1 if t is None else len(t)
+                               for t in tracebacks], 'i8')
+        save('traceback_data', np.frombuffer(
+            b''.join(t for t in tracebacks if t is not None), dtype='u1'))
+
+        row_samples = [samples.get((r.checksum, r.revision)) for r in rows]
+        save('samples_len', [-1 if s is None else len(s)
+                             for s in row_samples], 'i8')
+        save('samples_data', np.concatenate(
+            [s for s in row_samples if s is not None] or [[]]), 'f8')
+
+        save('aggregates_checksum', strings(r.checksum for r in aggregates))
+        save('aggregates_timestamp', [r.timestamp for r in aggregates],
+             'M8[us]')
+        save('aggregates_period', strings(r.period for r in aggregates))
+        save('aggregates_revision', strings(r.revision for r in aggregates))
+        save('aggregates_timing', floats(r.timing for r in aggregates), 'f8')
+        save('aggregates_median', floats(r.median for r in aggregates), 'f8')
+        save('aggregates_count', [r.count or 0 for r in aggregates], 'i8')
+
+        # written last, marks the export as complete
+        with open(os.path.join(path, ColumnarDB.META), 'w') as f:
+            json.dump(meta, f)
+        log.info("Exported %d results to %s" % (len(rows), path))
+
+    def import_columnar(self, path):
+        """Add benchmarks, results and blacklist exported to path
 
-        df = _sqa_to_frame(results).set_index('timestamp')
+        Results already present in this database are kept.
+        """
+        src = ColumnarDB(path)
+
+        benchmarks = src.get_benchmarks()
+        existing = set(self.get_benchmarks().index)
+        new = [_BenchmarkRecord(cs, row['name'], row['description'])
+               for cs, row in benchmarks.iterrows() if cs not in existing]
+        if new:
+            self.write_benchmarks(new)
+
+        tab = self._results
+        existing = set(tuple(x) for x in self.conn.execute(
+            sql.select([tab.c.checksum, tab.c.revision])))
+        rows = [row for row in src.iter_results()
+                if (row['checksum'], row['revision']) not in existing]
+        if rows:
+            self.write_results(rows)
+
+        atab = self._aggregates
+        existing = set(tuple(x) for x in self.conn.execute(
+            sql.select([atab.c.checksum, atab.c.timestamp])))
+        aggregates = [row for row in src.iter_aggregates()
+                      if (row['checksum'], row['timestamp']) not in existing]
+        if aggregates:
+            self._transaction(lambda conn: _upsert(conn, atab, aggregates))
+            self._cache.invalidate('results')
+
+        blacklist = set(self.get_rev_blacklist())
+        for rev in src.get_rev_blacklist():
+            if rev not in blacklist:
+                self.add_rev_blacklist(rev)
+        log.info("Imported %d results from %s" % (len(rows), path))
+
+
+class AllResults(object):
+    """Results of many benchmarks (see `BenchmarkDB.get_all_results`)
+
+    Attributes
+    ----------
+    timings : DataFrame
+      revisions x checksums, NaN where there is no timing.  Revisions are
+      ordered by timestamp
+    timestamps : Series
+      timestamp of every revision
+    tracebacks : dict
+      checksum: {revision: traceback} for the failed runs
+    """
+
+    def __init__(self, timings, timestamps, tracebacks):
+        self.timings = timings
+        self.timestamps = timestamps
+        self.tracebacks = tracebacks
+
+    @classmethod
+    def from_frame(cls, df):
+        """From frame with checksum, revision, timestamp, timing and
+        traceback columns, a row per result"""
+        if not len(df):
+            return cls(DataFrame(), Series(), {})
+
+        timestamps = df.groupby('revision')['timestamp'].first()
+        timestamps = timestamps.sort_values()
+        timings = df.pivot(index='revision', columns='checksum',
+                           values='timing').reindex(timestamps.index)
+        tracebacks = {}
+        for row in df[df['traceback'].notnull()].itertuples():
+            tracebacks.setdefault(row.checksum, {})[row.revision] = \
+                row.traceback
+        return cls(timings.astype(float), timestamps, tracebacks)
+
+    def get_benchmark_results(self, checksum):
+        """Return frame of the benchmark results as BenchmarkDB would
+
+        Only timestamp (index), revision, timing and traceback are provided
+        """
+        if checksum in self.timings:
+            timing = self.timings[checksum]
+        else:
+            timing = Series(np.nan, index=self.timings.index)
+        tracebacks = Series(self.tracebacks.get(checksum, {}),
+                            index=timing.index)
+        present = timing.notnull() | tracebacks.notnull()
+        revisions = timing.index[present.values]
+        df = DataFrame({'revision': revisions,
+                        'timing': timing[present].values,
+                        'traceback': tracebacks[present].values},
+                       index=self.timestamps[revisions].values,
+                       columns=['revision', 'timing', 'traceback'])
+        df.index.name = 'timestamp'
+        return df
+
+
+class ColumnarDB(object):
+    """Read-only results database exported by `BenchmarkDB.export_columnar`
+
+    Columns are memory-mapped, so only the rows of the queried benchmarks
+    are actually read from disk.  Provides the querying interface of
+    BenchmarkDB used by reports.
+    """
+
+    FORMAT = 1
+    META = 'meta.json'
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, self.META)) as f:
+            meta = json.load(f)
+        if meta['format'] != self.FORMAT:
+            raise ValueError("Unsupported columnar DB format %s in %s"
+                             % (meta['format'], path))
+        self._meta = meta
+        self._columns = {}
+
+    @classmethod
+    def is_columnar(cls, path):
+        return os.path.exists(os.path.join(path, cls.META))
+
+    def _column(self, name):
+        if name not in self._columns:
+            self._columns[name] = np.load(
+                os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        return self._columns[name]
+
+    def _offsets(self, name):
+        # start of every row's values in the concatenated data
+        key = name + '_offsets'
+        if key not in self._columns:
+            lengths = self._column(name + '_len')
+            self._columns[key] = np.concatenate(
+                [[0], np.cumsum(np.maximum(lengths, 0))])
+        return self._columns[key]
+
+    def _var_values(self, name, rows, convert):
+        lengths = self._column(name + '_len')
+        offsets = self._offsets(name)
+        data = self._column(name + '_data')
+        return [None if lengths[i] < 0
+                else convert(data[offsets[i]:offsets[i + 1]])
+                for i in rows]
+
+    def _strings(self, name, rows):
+        return self._column(name)[rows].astype(str)
+
+    def _frame(self, rows, columns):
+        getters = {
+            'checksum': lambda: self._strings('checksum', rows),
+            'revision': lambda: self._strings('revision', rows),
+            'timestamp': lambda: self._column('timestamp')[rows],
+            'ncalls': lambda: [x or None
+                               for x in self._strings('ncalls', rows)],
+            'timing': lambda: self._column('timing')[rows],
+            'traceback': lambda: self._var_values(
+                'traceback', rows, lambda x: x.tostring().decode('utf-8')),
+            'carried_from': lambda: [x or None for x in
+                                     self._strings('carried_from', rows)],
+        }
+        df = DataFrame(dict((c, getters[c]()) for c in columns),
+                       columns=columns)
+        # NULL timings are NaN here, None in the sqlite backend
+        df['timing'] = df['timing'].astype(object).where(
+            df['timing'].notnull(), None)
+        return df
+
+    def _has_aggregates(self):
+        # not in exports made before they were supported
+        return os.path.exists(os.path.join(self.path,
+                                           'aggregates_checksum.npy'))
+
+    def _aggregates_frame(self, rows):
+        def column(name):
+            return self._column('aggregates_' + name)[rows]
+        return DataFrame({'checksum': column('checksum').astype(str),
+                          'timestamp': column('timestamp'),
+                          'revision': column('revision').astype(str),
+                          'timing': column('timing'),
+                          'period': column('period').astype(str),
+                          'timing_median': column('median'),
+                          'nresults': column('count')},
+                         columns=['checksum', 'timestamp', 'revision',
+                                  'timing', 'period', 'timing_median',
+                                  'nresults'])
+
+    def _benchmark_rows(self, checksum, column='checksum'):
+        checksums = self._column(column)
+        checksum = _to_bytes(checksum)
+        return np.arange(checksums.searchsorted(checksum, 'left'),
+                         checksums.searchsorted(checksum, 'right'))
+
+    def get_benchmarks(self):
+        df = DataFrame(self._meta['benchmarks'],
+                       columns=['checksum', 'name', 'description'])
+        return df.set_index('checksum')
+
+    def get_rev_blacklist(self):
+        return list(self._meta['blacklist'])
+
+    def get_benchmark_results(self, checksum, stats=False, aggregated=True):
+        """See `BenchmarkDB.get_benchmark_results`"""
+        rows = self._benchmark_rows(checksum)
+        df = self._frame(rows, ['timestamp', 'revision', 'ncalls', 'timing',
+                                'traceback', 'carried_from'])
+        df = df.set_index('timestamp')
+        if stats:
+            df = df.join(self.get_samples_stats(checksum), on='revision')
+        if aggregated and self._has_aggregates():
+            rows = self._benchmark_rows(checksum, 'aggregates_checksum')
+            agg = self._aggregates_frame(rows)
+            if len(agg):
+                del agg['checksum']
+                df = concat([agg.set_index('timestamp'), df], sort=False)
         return df.sort_index()
 
+    def get_all_results(self, checksums=None, since=None):
+        """See `BenchmarkDB.get_all_results`"""
+        if checksums is not None:
+            rows = np.concatenate([self._benchmark_rows(cs)
+                                   for cs in sorted(set(checksums))] or [[]])
+            rows = rows.astype(int)
+        else:
+            rows = np.arange(len(self._column('checksum')))
+        if since is not None:
+            timestamps = self._column('timestamp')[rows]
+            rows = rows[timestamps >= np.datetime64(since)]
+        df = self._frame(rows, ['checksum', 'revision', 'timestamp',
+                                'timing', 'traceback'])
+
+        if self._has_aggregates():
+            agg = self._aggregates_frame(
+                np.arange(len(self._column('aggregates_checksum'))))
+            if checksums is not None:
+                agg = agg[agg['checksum'].isin(list(checksums))]
+            if since is not None:
+                agg = agg[agg['timestamp'] >= since]
+            if len(agg):
+                agg = agg[['checksum', 'revision', 'timestamp', 'timing']]
+                agg['traceback'] = None
+                df = concat([agg, df], sort=False)
+        return AllResults.from_frame(df)
+
+    def get_samples(self, checksum):
+        """Return dict of revision: array of all samples stored for it"""
+        rows = self._benchmark_rows(checksum)
+        samples = self._var_values('samples', rows, np.asarray)
+        return dict((rev, s) for rev, s in
+                    zip(self._strings('revision', rows), samples)
+                    if s is not None)
+
+    def get_samples_stats(self, checksum):
+        """Return frame of statistics of samples per revision"""
+        return _samples_stats(self.get_samples(checksum))
+
+    def iter_results(self):
+        """Yield every result as a row for `BenchmarkDB.write_results`"""
+        rows = np.arange(len(self._column('checksum')))
+        df = self._frame(rows, ['checksum', 'revision', 'timestamp', 'ncalls',
+                                'timing', 'traceback', 'carried_from'])
+        samples = self._var_values('samples', rows, list)
+        for i, row in enumerate(df.itertuples(index=False)):
+            yield dict(checksum=row.checksum, revision=row.revision,
+                       timestamp=row.timestamp.to_pydatetime(),
+                       ncalls=row.ncalls, timing=row.timing,
+                       traceback=row.traceback,
+                       carried_from=row.carried_from,
+                       samples=samples[i])
+
+
+    def iter_aggregates(self):
+        """Yield every aggregate as a row of the aggregates table"""
+        if not self._has_aggregates():
+            return
+        rows = np.arange(len(self._column('aggregates_checksum')))
+        df = self._aggregates_frame(rows)
+        for row in df.itertuples(index=False):
+            yield dict(checksum=row.checksum,
+                       timestamp=row.timestamp.to_pydatetime(),
+                       period=row.period, revision=row.revision,
+                       timing=None if np.isnan(row.timing) else row.timing,
+                       median=(None if np.isnan(row.timing_median)
+                               else row.timing_median),
+                       count=int(row.nresults))
+
+
+class _BenchmarkRecord(object):
+    # what write_benchmarks needs of a Benchmark
+
+    def __init__(self, checksum, name, description):
+        self.checksum = checksum
+        self.name = name
+        self.description = description
+
+
+class _QueryCache(object):
+    """Bounded LRU cache of query results invalidated by tags
+
+    Every entry is stored with a list of tags, and invalidating a tag
+    drops all the entries carrying it.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def get(self, key, tags, compute):
+        """Return cached value for key, calling compute() on a miss"""
+        if key in self._entries:
+            entry = self._entries.pop(key)
+        else:
+            entry = (set(tags), compute())
+        if self.maxsize:
+            self._entries[key] = entry
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry[1]
+
+    def invalidate(self, *tags):
+        tags = set(tags)
+        for key, (entry_tags, _) in self._entries.items():
+            if entry_tags & tags:
+                del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+
+def _upsert(conn, table, rows):
+    """Insert rows, replacing the existing ones with the same primary key"""
+    dialect = conn.dialect.name
+    if dialect == 'sqlite':
+        conn.execute(table.insert().prefix_with('OR REPLACE'), rows)
+    elif dialect == 'postgresql':
+        conn.execute(_postgresql_upsert(table), rows)
+    else:
+        # no portable upsert, concurrent inserts of the same key end up
+        # with an IntegrityError and the transaction is retried
+        _delete_keys(conn, table, rows)
+        conn.execute(table.insert(), rows)
+
+
+def _postgresql_upsert(table):
+    stmt = postgresql.insert(table)
+    update = dict((c.name, stmt.excluded[c.name])
+                  for c in table.columns if not c.primary_key)
+    if not update:
+        return stmt.on_conflict_do_nothing()
+    return stmt.on_conflict_do_update(
+        index_elements=[c.name for c in table.primary_key], set_=update)
+
+
+def _delete_keys(conn, table, rows):
+    """Delete rows with primary keys of rows"""
+    keys = list(table.primary_key)
+    stmt = table.delete().where(
+        sql.and_(*[c == sql.bindparam('_' + c.name) for c in keys]))
+    conn.execute(stmt, [dict(('_' + c.name, row[c.name]) for c in keys)
+                        for row in rows])
+
+
+# error messages of sqlite and postgresql worth retrying the transaction
+_TRANSIENT_ERRORS = ('database is locked', 'database is busy',
+                     'deadlock detected', 'could not serialize',
+                     'unique', 'duplicate')
+
+
+def _is_transient(error):
+    message = str(error.orig).lower()
+    return any(x in message for x in _TRANSIENT_ERRORS)
+
+
+def _samples_stats(samples):
+    columns = ['mean', 'median', 'std', 'min', 'nsamples']
+    revisions = sorted(samples)
+    # sample standard deviation, as used for the precision of timings
+    # (see vbench.benchmark.relative_ci_halfwidth)
+    data = [(s.mean(), np.median(s),
+             s.std(ddof=1) if len(s) > 1 else np.nan, s.min(), len(s))
+            for s in (samples[r] for r in revisions)]
+    return DataFrame(data, index=revisions, columns=columns)
+
+
+def _to_bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+
+def _pack_samples(samples):
+    return struct.pack('<%dd' % len(samples), *samples)
+
+
+def _unpack_samples(blob):
+    return np.frombuffer(blob, dtype='<f8')
+
+
+def _set_sqlite_pragmas(dbapi_conn, connection_record):
+    cursor = dbapi_conn.cursor()
+    # readers do not block the writer and vice versa
+    cursor.execute('PRAGMA journal_mode=WAL')
+    # with WAL it is still safe against corruption, just does not fsync
+    # on every commit
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    # in KiB if negative
+    cursor.execute('PRAGMA cache_size=-65536')
+    cursor.close()
+
 
 def _sqa_to_frame(result):
     rows = [tuple(x) for x in result]
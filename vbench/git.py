@@ -1,12 +1,16 @@
-from dateutil import parser
+from fnmatch import fnmatch
+import cPickle as pickle
+import hashlib
 import subprocess
 import os
 import shutil
+import tempfile
+import time
 
 import numpy as np
 
-from pandas import Series, DataFrame, Panel
-from vbench.utils import run_cmd
+from pandas import Categorical, Index, Series, DataFrame, Panel, to_datetime
+from vbench.utils import run_cmd, confine_cmd
 
 import logging
 log = logging.getLogger('vb.git')
@@ -23,60 +27,134 @@ class Repo(object):
 class GitRepo(Repo):
     """
     Read some basic statistics about a git repository
+
+    cache_dir : string or None
+        directory to keep an index of the commit log (and of the churn) in.
+        Later only the commits added since are read from git, unless the
+        history was rewritten
     """
 
-    def __init__(self, repo_path):
+    # fields of a commit in the git log output
+    _LOG_FORMAT = '%H%x00%h%x00%P%x00%ct%x00%s%x00%an'
+    _LOG_FIELDS = 6
+
+    def __init__(self, repo_path, cache_dir=None):
         log.info("Initializing GitRepo to look at %s" % repo_path)
         self.repo_path = repo_path
+        self.cache_dir = cache_dir
         self.git = _git_command(self.repo_path)
+        self._changed_paths = {}
         (self.shas, self.messages,
          self.timestamps, self.authors) = self._parse_commit_log()
 
     @property
     def commit_date(self):
-        from pandas.core.datetools import normalize_date
-        return self.timestamps.map(normalize_date)
+        return self.timestamps.dt.normalize()
 
-    def _parse_commit_log(self):
-        log.debug("Parsing the commit log of %s" % self.repo_path)
+    def _read_commit_log(self, revs):
+        """Return (full sha, sha, parents, timestamp, message, author)
+        records of the mainline commits in revs, newest first"""
         # yoh: using --first-parent so we traverse only the "main"
         #      chain of commits, thus avoiding jumping across possibly
         #      present multiple parallel branches which would introduce
         #      different performance impacts, and in general might be of
         #      no interest (unless they are already merged in the main line)
         # TODO: make it optional
-        githist = self.git + ('log --graph  --pretty=format:'
-                              '\"::%h::%cd::%s::%an\" --first-parent'
-                              '> githist.txt')
-        os.system(githist)
-        githist = open('githist.txt').read()
-        os.remove('githist.txt')
+        # fields of a commit, and commits, are separated by NULs
+        fields = _git_stream(self.repo_path,
+                             ['log', '--first-parent', '-z',
+                              '--pretty=format:' + self._LOG_FORMAT] + revs)
+        return [(full_sha, sha, parents, int(stamp), message, author)
+                for full_sha, sha, parents, stamp, message, author
+                in zip(*[fields] * self._LOG_FIELDS)]
+
+    def _get_commit_records(self):
+        head = _git_output(self.repo_path, ['rev-parse', 'HEAD']).strip()
+        self._head = head
+        index = self._load_index('commits')
+        if index is not None and index['head'] == head:
+            return index['records']
+
+        records = None
+        if index is not None:
+            try:
+                records = self._read_commit_log([head, '^' + index['head']])
+            except RuntimeError:
+                # indexed head is gone
+                records = []
+            # new commits must continue the indexed mainline
+            if records and records[-1][2].split(' ')[0] == index['head']:
+                log.debug("Read %d new commits of %s"
+                          % (len(records), self.repo_path))
+                records += index['records']
+            else:
+                log.info("History of %s was rewritten, reading all of it"
+                         % self.repo_path)
+                records = None
+        if records is None:
+            records = self._read_commit_log([head])
+        self._store_index('commits', dict(head=head, records=records))
+        return records
+
+    def _index_path(self, name):
+        key = hashlib.sha1(os.path.abspath(self.repo_path)).hexdigest()
+        return os.path.join(self.cache_dir, '%s_%s.pickle' % (name, key))
+
+    def _load_index(self, name):
+        if self.cache_dir is None:
+            return None
+        path = self._index_path(name)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except Exception, e:
+            log.warn("Ignoring broken %s index %s: %s" % (name, path, e))
+            return None
+
+    def _store_index(self, name, index):
+        if self.cache_dir is None:
+            return
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = self._index_path(name)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
 
+    def _parse_commit_log(self):
+        log.debug("Parsing the commit log of %s" % self.repo_path)
+        full_shas = []
         shas = []
-        timestamps = []
+        stamps = []
         messages = []
         authors = []
-        for line in githist.split('\n'):
-            # skip commits not in mainline
-            if not line[0] == '*':
-                continue
-            # split line into three real parts, ignoring git-graph in front
-            _, sha, stamp, message, author = line.split('::', 4)
-
-            # parse timestamp into datetime object
-            stamp = parser.parse(stamp)
+        seen = set()
+        records = self._get_commit_records()
+        self._mainline = set(record[0] for record in records)
+        for full_sha, sha, _, stamp, message, author in records:
             # avoid duplicate timestamps by ignoring them
             # presumably there is a better way to deal with this
-            if stamp in timestamps:
+            if stamp in seen:
                 continue
+            seen.add(stamp)
 
+            full_shas.append(full_sha)
             shas.append(sha)
-            timestamps.append(stamp)
+            stamps.append(stamp)
             messages.append(message)
             authors.append(author)
 
-        # to UTC for now
-        timestamps = _convert_timezones(timestamps)
+        # position of every commit in the (oldest first) series, by both
+        # full and abbreviated sha
+        n = len(shas)
+        self._positions = dict((sha, n - 1 - i) for i, sha in enumerate(shas))
+        self._positions.update((sha, n - 1 - i)
+                               for i, sha in enumerate(full_shas))
+
+        # seconds since epoch to naive UTC
+        timestamps = to_datetime(np.array(stamps, dtype=np.int64), unit='s')
 
         shas = Series(shas, timestamps)
         messages = Series(messages, shas)
@@ -85,34 +163,113 @@ class GitRepo(Repo):
         return shas[::-1], messages[::-1], timestamps[::-1], authors[::-1]
 
     def get_churn(self, omit_shas=None, omit_paths=None):
-        churn = self.get_churn_by_file()
+        """Return insertions + deletions of the mainline commits per day"""
+        churn = self._get_churn_index()
+        commits = np.asarray(churn['shas'])
+        keep = np.ones(len(churn['path']), dtype=bool)
 
         if omit_paths is not None:
-            churn = churn.drop(omit_paths, axis='major')
+            omit_paths = set(omit_paths)
+            ids = [i for i, path in enumerate(churn['paths'])
+                   if path in omit_paths]
+            keep &= ~np.in1d(churn['path'], ids)
 
         if omit_shas is not None:
-            churn = churn.drop(omit_shas, axis='minor')
+            keep &= ~np.in1d(commits, list(omit_shas))[churn['commit']]
 
         # sum files and add insertions + deletions
-        by_commit = churn.sum('major').sum(1)
-        by_date = by_commit.groupby(self.commit_date).sum()
-        return by_date
+        by_commit = np.bincount(churn['commit'][keep],
+                                weights=(churn['insertions'][keep]
+                                         + churn['deletions'][keep]),
+                                minlength=len(commits)).astype(np.int64)
+        dates = to_datetime(churn['stamps'], unit='s').normalize()
+        by_commit = Series(by_commit, index=dates)
+        if omit_shas is not None:
+            by_commit = by_commit[~np.in1d(commits, list(omit_shas))]
+        return by_commit.groupby(level=0).sum()
 
     def get_churn_by_file(self):
-        hashes = self.shas.values
-        prev = hashes[0]
-
-        insertions = {}
-        deletions = {}
-
-        for cur in hashes[1:]:
-            i, d = self.diff(cur, prev)
-            insertions[cur] = i
-            deletions[cur] = d
-            prev = cur
-        return Panel({'insertions': DataFrame(insertions),
-                      'deletions': DataFrame(deletions)},
-                     minor_axis=hashes)
+        """Return frame of insertions and deletions by sha and path"""
+        churn = self._get_churn_index()
+        shas = Categorical.from_codes(churn['commit'], churn['shas'])
+        paths = Categorical.from_codes(churn['path'], churn['paths'])
+        return DataFrame({'sha': shas, 'path': paths,
+                          'insertions': churn['insertions'],
+                          'deletions': churn['deletions']},
+                         columns=['sha', 'path', 'insertions', 'deletions'])
+
+    def _get_churn_index(self):
+        """Return churn of all the mainline commits in long format
+
+        Dict of shas and stamps (seconds since epoch) of the commits,
+        newest first, the (interned) paths, and arrays of commit (position
+        in shas), path (position in paths), insertions and deletions with
+        an entry per file changed by a commit.
+        """
+        if getattr(self, '_churn', None) is not None:
+            return self._churn
+        index = self._load_index('churn')
+        if index is None or index['head'] not in self._mainline:
+            index = self._read_churn([self._head])
+        elif index['head'] != self._head:
+            new = self._read_churn([self._head, '^' + index['head']],
+                                   index['paths'])
+            log.debug("Read churn of %d new commits of %s"
+                      % (len(new['shas']), self.repo_path))
+            for key in ('shas', 'stamps'):
+                new[key] = new[key] + index[key]
+            # positions in shas are shifted by the new commits
+            index['commit'] += len(new['shas']) - len(index['shas'])
+            for key in ('commit', 'path', 'insertions', 'deletions'):
+                new[key] = np.concatenate([new[key], index[key]])
+            index = new
+        else:
+            self._churn = index
+            return index
+        self._store_index('churn', index)
+        self._churn = index
+        return index
+
+    def _read_churn(self, revs, paths=None):
+        """Read churn of the mainline commits in revs with a single git log,
+        see `_get_churn_index`"""
+        paths = list(paths or [])
+        path_ids = dict((path, i) for i, path in enumerate(paths))
+        shas, stamps = [], []
+        commit, path, insertions, deletions = [], [], [], []
+        # -m with --first-parent diffs merges against their first parent
+        # only.  With -z a commit header is followed by a newline and the
+        # first NUL terminated "insertions\tdeletions\tpath" entry
+        tokens = _git_stream(self.repo_path,
+                             ['log', '--first-parent', '-m', '--numstat',
+                              '--no-renames', '-z',
+                              '--pretty=format:commit %h %ct'] + revs)
+        for token in tokens:
+            if token.startswith('commit '):
+                header, _, token = token.partition('\n')
+                _, sha, stamp = header.split(' ')
+                shas.append(sha)
+                stamps.append(int(stamp))
+                if not token:
+                    continue
+            elif not token:
+                continue
+            i, d, filename = token.split('\t', 2)
+            if i == '-':
+                # binary file
+                continue
+            if filename not in path_ids:
+                path_ids[filename] = len(paths)
+                paths.append(filename)
+            commit.append(len(shas) - 1)
+            path.append(path_ids[filename])
+            insertions.append(int(i))
+            deletions.append(int(d))
+        return dict(head=self._head, shas=shas, stamps=stamps, paths=paths,
+                    commit=np.array(commit, dtype=np.int32),
+                    path=np.array(path, dtype=np.int32),
+                    insertions=np.array(insertions, dtype=np.int32),
+                    deletions=np.array(deletions, dtype=np.int32))
 
     def diff(self, sha, prev_sha):
         cmdline = self.git.split() + ['diff', sha, prev_sha, '--numstat']
@@ -139,41 +296,113 @@ class GitRepo(Repo):
         # deletions = int(match.group(2))
         return insertions, deletions
 
+    def changed_paths(self, sha, prev_sha):
+        """Return list of paths which differ between prev_sha and sha"""
+        key = (prev_sha, sha)
+        if key not in self._changed_paths:
+            stdout = _git_output(self.repo_path,
+                                 ['diff', '--name-only', '-z', prev_sha, sha])
+            self._changed_paths[key] = [x for x in stdout.split('\0') if x]
+        return self._changed_paths[key]
+
     def checkout(self, sha):
         pass
 
     def get_commit_info(self, sha):
-        # since all the information is stored in separate series, find
-        # that revision first
-        sha_where = np.where(self.shas.values==sha)
-        if not len(sha_where):
-            return None
-        if len(sha_where[0])>1:
-            log.warning("Found multiple (%d) entries corresponding to %s."
-                        % (len(sha_where[0], sha)))
+        """Return dict of timestamp, sha, message and authors of a commit
+
+        sha can be full or abbreviated.  None if it is not in the mainline
+        """
+        i = self._positions.get(sha)
+        if i is None:
             return None
-        i = sha_where[0][0]
-        return {'timestamp': self.timestamps[i],
+        return {'timestamp': self.timestamps.iat[i],
                 'sha': sha,
-                'message': self.messages[i],
-                'authors': self.authors[i]}
+                'message': self.messages.iat[i],
+                'authors': self.authors.iat[i]}
+
+    def get_commit_infos(self, shas):
+        """Return frame of timestamp, message and authors of the commits,
+        indexed by shas (full or abbreviated).  NaN for unknown ones
+        """
+        positions = np.array([self._positions.get(sha, -1) for sha in shas],
+                             dtype=int)
+        known = positions >= 0
+        df = DataFrame(index=Index(shas, name='sha'),
+                       columns=['timestamp', 'message', 'authors'])
+        df['timestamp'] = to_datetime(df['timestamp'])
+        for column, series in (('timestamp', self.timestamps),
+                               ('message', self.messages),
+                               ('authors', self.authors)):
+            df.loc[known, column] = series.values[positions[known]]
+        return df
 
 
 class BenchRepo(object):
     """
     Manage an isolated copy of a repository for benchmarking
+
+    build_nice and build_cpus allow to lower the priority of the build and
+    to restrict it to the given CPUs (see `confine_cmd`), e.g. so it does
+    not disturb benchmarks timed concurrently in another checkout.
+
+    build_cache : BuildCache or None
+        if given, artifacts of previous builds of identical sources are
+        restored instead of running build_cmds
+    compiler_cache : CompilerCache or None
+        if given, compilers invoked by build_cmds go through it, and its
+        hit rate for every build is logged (exact only if no other
+        checkout builds with the same cache meanwhile)
+
+    source_url is cloned once into target_dir + '_tmp', which serves as
+    the object store: the checkout in target_dir is a --shared clone of it
+    (borrowing its objects instead of copying them), so (re)creating it
+    costs only the working tree.
+
+    object_store : str or None
+        existing clone of source_url to use as the object store instead,
+        e.g. target_dir_tmp of another BenchRepo, so that many checkouts
+        share one copy of the history
+
+    hard_clean brings the checkout back to a pristine state at one of
+    CLEAN_LEVELS, from the cheapest to the most thorough:
+
+    clean
+        git reset --hard and git clean -xdff
+    full
+        also rebuild the index, drop stale git locks and clean submodules
+    reclone
+        delete the checkout and clone it again
+
+    A level falls back to the next one if its commands fail.  How many
+    times each level was used and the time it took is collected in
+    clean_stats.
     """
+
+    CLEAN_LEVELS = ('clean', 'full', 'reclone')
+
     def __init__(self, source_url, target_dir, build_cmds, prep_cmd,
-                 clean_cmd=None, dependencies=None, always_clean=False):
+                 clean_cmd=None, dependencies=None, always_clean=False,
+                 build_nice=None, build_cpus=None, build_cache=None,
+                 object_store=None, compiler_cache=None):
         self.source_url = source_url
         self.target_dir = target_dir
-        self.target_dir_tmp = target_dir + '_tmp'
+        self.target_dir_tmp = object_store or (target_dir + '_tmp')
         self.build_cmds = build_cmds
         self.prep_cmd = prep_cmd
         self.clean_cmd = clean_cmd
         self.dependencies = dependencies
         self.always_clean = always_clean
-        self._clean_checkout()
+        self.build_nice = build_nice
+        self.build_cpus = build_cpus
+        self.build_cache = build_cache
+        self.compiler_cache = compiler_cache
+        # checked out revision
+        self.revision = None
+        self.clean_stats = dict((level, {'count': 0, 'time': 0.0})
+                                for level in self.CLEAN_LEVELS)
+        if object_store is None:
+            self._clean_checkout()
         self._copy_repo()
 
     def _clean_checkout(self):
@@ -183,10 +412,13 @@ class BenchRepo(object):
 
     def _copy_repo(self):
         log.debug("Repopulating %s" % self.target_dir)
-        self._clone(self.target_dir_tmp, self.target_dir, rm=True)
+        # objects stay in target_dir_tmp, which must not be garbage
+        # collected while the checkout is in use
+        self._clone(self.target_dir_tmp, self.target_dir, rm=True,
+                    options=['--shared'])
         self._prep()
 
-    def _clone(self, source, target, rm=False):
+    def _clone(self, source, target, rm=False, options=()):
         log.info("Cloning %s over to %s" % (source, target))
         if os.path.exists(target):
             if rm:
@@ -200,7 +432,7 @@ class BenchRepo(object):
             else:
                 raise RuntimeError("Target directory %s already exists. "
                                    "Can't clone into it" % target)
-        run_cmd(['git', 'clone', source, target])
+        run_cmd(['git', 'clone'] + list(options) + [source, target])
 
     def _copy_benchmark_scripts_and_deps(self):
         pth, _ = os.path.split(os.path.abspath(__file__))
@@ -232,15 +464,36 @@ class BenchRepo(object):
         args = git.split() + rest.split()
         # checkout of a detached commit would always produce stderr
         proc = run_cmd(args, stderr_levels=('debug', 'error'))
+        self.revision = rev
 
     def _build(self):
+        cache_key = None
+        if self.build_cache is not None:
+            cache_key = self.build_cache.get_key(self.target_dir,
+                                                 self.build_cmds)
+            if self.build_cache.restore(cache_key, self.target_dir):
+                return
+
         cmd = ';'.join([x for x in self.build_cmds.split('\n')
                         if len(x.strip()) > 0])
-        proc = run_cmd(cmd, shell=True, cwd=self.target_dir)
+        cmd = confine_cmd(cmd, cpus=self.build_cpus, nice=self.build_nice)
+        env = None
+        if self.compiler_cache is not None:
+            env = dict(os.environ,
+                       **self.compiler_cache.get_env(self.target_dir))
+            stats = self.compiler_cache.get_stats(env)
+        proc = run_cmd(cmd, shell=True, cwd=self.target_dir, env=env)
+        if self.compiler_cache is not None:
+            self.compiler_cache.log_stats(stats,
+                                          self.compiler_cache.get_stats(env),
+                                          self.revision)
         if proc.returncode:
             raise FailedToBuildError(
                 "Failed to build. See stderr in the log for details")
 
+        if cache_key is not None:
+            self.build_cache.store(cache_key, self.target_dir)
+
     def _prep(self):
         cmd = ';'.join([x for x in self.prep_cmd.split('\n')
                         if len(x.strip()) > 0])
@@ -253,15 +506,95 @@ class BenchRepo(object):
                         if len(x.strip()) > 0])
         proc = run_cmd(cmd, shell=True, cwd=self.target_dir)
 
-    def hard_clean(self):
+    def hard_clean(self, level='clean'):
+        """Clean the checkout at level (see CLEAN_LEVELS) or a higher one
+
+        Returns the level which was used
+        """
+        levels = self.CLEAN_LEVELS
+        for level in levels[levels.index(level):]:
+            log.info("Hard cleaning %s (%s)" % (self.target_dir, level))
+            start = time.time()
+            ok = getattr(self, '_hard_clean_' + level)()
+            stats = self.clean_stats[level]
+            stats['count'] += 1
+            stats['time'] += time.time() - start
+            if ok:
+                return level
+            log.warn("Hard cleaning %s (%s) failed" % (self.target_dir, level))
+
+    def _git_cmds(self, cmds):
+        """Run git commands in the checkout, return True if all succeeded"""
+        if not os.path.isdir(os.path.join(self.target_dir, '.git')):
+            # git would look for a repository in the parent directories
+            return False
+        for cmd in cmds:
+            proc = run_cmd(['git'] + cmd.split(), cwd=self.target_dir)
+            if proc.returncode:
+                return False
+        return True
+
+    def _hard_clean_clean(self):
+        # clean is forced twice to also remove untracked nested repositories
+        if not self._git_cmds(['reset -q --hard', 'clean -q -xdff']):
+            return False
+        self._prep()
+        return True
+
+    def _hard_clean_full(self):
+        git_dir = os.path.join(self.target_dir, '.git')
+        if not os.path.isdir(git_dir):
+            return False
+        # left behind by an interrupted git command
+        for root, dirs, files in os.walk(git_dir):
+            for f in files:
+                if f.endswith('.lock'):
+                    os.unlink(os.path.join(root, f))
+        index = os.path.join(git_dir, 'index')
+        if os.path.exists(index):
+            os.unlink(index)
+        if not self._git_cmds(['reset -q --hard', 'clean -q -xdff']):
+            return False
+        # submodules are cleaned within the checkout directory
+        if os.path.exists(os.path.join(self.target_dir, '.gitmodules')):
+            ok = self._git_cmds(['submodule -q update --init --force '
+                                 '--recursive',
+                                 'submodule -q foreach --recursive '
+                                 'git clean -q -xdff'])
+            if not ok:
+                return False
+        self._prep()
+        return True
+
+    def _hard_clean_reclone(self):
         self._copy_repo()
+        return True
 
     def _clean_pyc_files(self, extensions=('.pyc', '.pyo')):
-        clean_me = []
-        for root, dirs, files in list(os.walk(self.target_dir)):
-            for f in files:
-                if os.path.splitext(f)[-1] in extensions:
-                    clean_me.append(os.path.join(root, f))
+        # git lists them much faster than walking the tree would, and does
+        # not descend into .git.  Nor into submodules though, so those are
+        # listed on their own
+        patterns = ['*' + ext for ext in extensions]
+        try:
+            submodules = _git_output(
+                self.target_dir, ['submodule', '--quiet', 'foreach',
+                                  '--recursive', 'echo "$toplevel/$sm_path"'])
+            clean_me = []
+            for repo_dir in [self.target_dir] + submodules.splitlines():
+                stdout = _git_output(repo_dir,
+                                     ['ls-files', '-z', '--cached', '--others',
+                                      '--'] + patterns)
+                clean_me.extend(os.path.join(repo_dir, path)
+                                for path in stdout.split('\0') if path)
+        except RuntimeError, e:
+            log.warn("Walking %s for bytecode files: %s" % (self.target_dir, e))
+            clean_me = []
+            for root, dirs, files in os.walk(self.target_dir):
+                if '.git' in dirs:
+                    dirs.remove('.git')
+                for f in files:
+                    if os.path.splitext(f)[-1] in extensions:
+                        clean_me.append(os.path.join(root, f))
 
         for path in clean_me:
             try:
@@ -270,15 +603,260 @@ class BenchRepo(object):
                 pass
 
 
-def _convert_timezones(stamps):
-    # tz = config.TIME_ZONE
-    def _convert(dt):
-        offset = dt.tzinfo.utcoffset(dt)
-        dt = dt.replace(tzinfo=None)
-        dt = dt - offset
-        return dt
+class BuildCache(object):
+    """
+    Content-addressed cache of build artifacts
+
+    Artifacts are keyed by the hash of the git tree entries of the build
+    relevant paths (and the build commands), so revisions which touch only
+    e.g. docs or tests reuse the already built extensions.
+
+    Parameters
+    ----------
+    cache_dir : str
+        where to store the artifacts
+    paths : list of str or None
+        fnmatch-style globs (matched against paths relative to the top of
+        the repository) of the files affecting the build.  None means all
+        files in the tree
+    artifacts : list of str
+        globs of the untracked files produced by the build to be cached
+    max_size : int
+        maximal total size (in bytes) of the cache.  Least recently used
+        entries get evicted when exceeded
+    """
+
+    def __init__(self, cache_dir, paths=None, artifacts=('*.so', '*.pyd'),
+                 max_size=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.paths = paths
+        self.artifacts = artifacts
+        self.max_size = max_size
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get_key(self, repo_path, build_cmds=''):
+        """Compute the cache key for the currently checked out tree"""
+        tree = _git_output(repo_path, ['ls-tree', '-r', '-z', 'HEAD'])
+        key = hashlib.sha1(build_cmds)
+        for entry in tree.split('\0'):
+            if not entry:
+                continue
+            path = entry.split('\t', 1)[1]
+            if self.paths is None or _fnmatch_any(path, self.paths):
+                key.update(entry)
+                key.update('\0')
+        return key.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def restore(self, key, repo_path):
+        """Copy cached artifacts into repo_path. Returns True on a hit"""
+        entry = self._entry_path(key)
+        if not os.path.isdir(entry):
+            log.debug("Build cache miss for %s" % key)
+            return False
+        try:
+            # mark as recently used first, so a concurrent eviction (by
+            # another checkout) picks other entries while we are copying
+            os.utime(entry, None)
+            log.info("Build cache hit for %s, restoring artifacts" % key)
+            for root, dirs, files in os.walk(entry, onerror=_reraise):
+                rel_root = os.path.relpath(root, entry)
+                target_root = os.path.normpath(os.path.join(repo_path,
+                                                            rel_root))
+                if not os.path.exists(target_root):
+                    os.makedirs(target_root)
+                for f in files:
+                    shutil.copy2(os.path.join(root, f),
+                                 os.path.join(target_root, f))
+        except (IOError, OSError), e:
+            # e.g. evicted nevertheless -- just build it
+            log.warn("Failed to restore %s from the build cache: %s"
+                     % (key, e))
+            return False
+        return True
+
+    def store(self, key, repo_path):
+        """Store artifacts produced by the build in repo_path under key"""
+        untracked = _git_output(repo_path,
+                                ['ls-files', '--others', '-z'])
+        artifacts = [x for x in untracked.split('\0')
+                     if x and _fnmatch_any(x, self.artifacts)]
+        if not artifacts:
+            log.debug("No build artifacts to cache in %s" % repo_path)
+            return
+        entry = self._entry_path(key)
+        if os.path.exists(entry):
+            return
+        # populate aside and move in place, so concurrent users of the
+        # cache never see a partial entry
+        tmp_entry = '%s.%d.tmp' % (entry, os.getpid())
+        for path in artifacts:
+            target = os.path.join(tmp_entry, path)
+            if not os.path.exists(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            shutil.copy2(os.path.join(repo_path, path), target)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # someone else has stored it meanwhile
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            return
+        log.info("Stored %d build artifacts under %s"
+                 % (len(artifacts), key))
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for key in os.listdir(self.cache_dir):
+            entry = self._entry_path(key)
+            if key.endswith('.tmp') or not os.path.isdir(entry):
+                continue
+            size = _du(entry)
+            entries.append((os.stat(entry).st_mtime, size, entry))
+            total += size
+        # least recently used first
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            log.debug("Evicting %s from the build cache" % entry)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+class CompilerCache(object):
+    """
+    Pass compilers of the builds through ccache
+
+    Consecutive revisions share most of their sources, so most of the
+    compilations of a revision are served from the cache.
+
+    Hit rates logged per build are taken from the global counters of the
+    cache, so they are exact only while builds sharing the cache do not
+    run concurrently (e.g. BenchmarkRunner with build_workers=1).
+
+    Parameters
+    ----------
+    cache_dir : str or None
+        where to keep the cache.  None means ccache's default
+    max_size : str or None
+        maximal size of the cache, e.g. '5G'.  None means ccache's default
+    cc, cxx : str
+        compilers to wrap
+    command : str
+        the ccache executable
+    """
 
-    return [_convert(x) for x in stamps]
+    def __init__(self, cache_dir=None, max_size=None, cc='gcc', cxx='g++',
+                 command='ccache'):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.cc = cc
+        self.cxx = cxx
+        self.command = command
+
+    def get_env(self, build_dir):
+        """Return environment variables for a build in build_dir"""
+        env = {'CC': '%s %s' % (self.command, self.cc),
+               'CXX': '%s %s' % (self.command, self.cxx),
+               # paths within the checkout are hashed as relative ones, so
+               # checkouts in different directories share the cache
+               'CCACHE_BASEDIR': os.path.abspath(build_dir),
+               'CCACHE_NOHASHDIR': '1'}
+        if self.cache_dir is not None:
+            env['CCACHE_DIR'] = os.path.abspath(self.cache_dir)
+        if self.max_size is not None:
+            env['CCACHE_MAXSIZE'] = str(self.max_size)
+        return env
+
+    def get_stats(self, env=None):
+        """Return (hits, misses) counted by the cache so far, or None
+
+        Requires ccache >= 3.7 for its --print-stats
+        """
+        try:
+            proc = subprocess.Popen([self.command, '--print-stats'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, env=env)
+        except OSError, e:
+            log.warn("Cannot get statistics of %s: %s" % (self.command, e))
+            return None
+        stdout, _ = proc.communicate()
+        if proc.returncode:
+            return None
+        counters = {}
+        for line in stdout.splitlines():
+            fields = line.split('\t')
+            if len(fields) == 2 and fields[1].strip().isdigit():
+                counters[fields[0]] = int(fields[1])
+        hits = (counters.get('direct_cache_hit', 0)
+                + counters.get('preprocessed_cache_hit', 0))
+        return hits, counters.get('cache_miss', 0)
+
+    def log_stats(self, before, after, revision):
+        """Log hit rate of a build from the stats before and after it
+
+        Includes compilations of any concurrent builds using the cache
+        """
+        if before is None or after is None:
+            return
+        hits, misses = after[0] - before[0], after[1] - before[1]
+        if hits + misses:
+            log.info("Compiler cache hit rate building %s: %.0f%% "
+                     "(%d hits, %d misses)"
+                     % (revision, 100. * hits / (hits + misses), hits,
+                        misses))
+
+
+def _fnmatch_any(path, patterns):
+    return any(fnmatch(path, p) for p in patterns)
+
+
+def _reraise(e):
+    raise e
+
+
+def _du(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total
+
+
+def _git_output(repo_path, args):
+    cmdline = _git_command(repo_path).split() + args
+    proc = subprocess.Popen(cmdline, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate()
+    if proc.returncode:
+        raise RuntimeError("%s failed: %s" % (' '.join(cmdline), stderr))
+    return stdout
+
+
+def _git_stream(repo_path, args, sep='\0', bufsize=1 << 16):
+    """Yield sep separated tokens of git output as it is produced"""
+    cmdline = _git_command(repo_path).split() + args
+    stderr = tempfile.TemporaryFile()
+    proc = subprocess.Popen(cmdline, stdout=subprocess.PIPE, stderr=stderr)
+    rest = ''
+    while True:
+        chunk = proc.stdout.read(bufsize)
+        if not chunk:
+            break
+        tokens = (rest + chunk).split(sep)
+        rest = tokens.pop()
+        for token in tokens:
+            yield token
+    if rest:
+        yield rest
+    if proc.wait():
+        stderr.seek(0)
+        raise RuntimeError("%s failed: %s"
+                           % (' '.join(cmdline), stderr.read()))
 
 
 def _git_command(repo_path):
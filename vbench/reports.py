@@ -21,6 +21,11 @@ def group_benchmarks_by_module(benchmarks):
         benchmarks_by_module[module_name].append(b)
     return benchmarks_by_module
 
+def _get_all_results(benchmarks, dbpath):
+    from vbench.db import BenchmarkDB
+    db = BenchmarkDB.get_instance(dbpath)
+    return db.get_all_results([b.checksum for b in benchmarks])
+
 def generate_rst_files(benchmarks, dbpath, outpath, description=""):
     import matplotlib as mpl
     mpl.use('Agg')
@@ -38,6 +43,7 @@ def generate_rst_files(benchmarks, dbpath, outpath, description=""):
         os.makedirs(fig_base_path)
 
     log.info("Generating rst files for %d benchmarks" % (len(benchmarks)))
+    all_results = _get_all_results(benchmarks, dbpath)
     for bmk in benchmarks:
         log.debug('Generating rst file for %s' % bmk.name)
         rst_path = os.path.join(outpath, 'vbench/%s.rst' % bmk.name)
@@ -47,7 +53,8 @@ def generate_rst_files(benchmarks, dbpath, outpath, description=""):
         # make the figure
         plt.figure(figsize=(10, 6))
         ax = plt.gca()
-        bmk.plot(dbpath, ax=ax)
+        bmk.plot(dbpath, ax=ax,
+                 results=all_results.get_benchmark_results(bmk.checksum))
 
         start, end = ax.get_xlim()
 
@@ -101,10 +108,11 @@ Benchmarks Performance Analysis
 ===============================
 """
         all_res = []
+        all_results = _get_all_results(benchmarks, dbpath)
         for b in benchmarks:
+            results = all_results.get_benchmark_results(b.checksum)
             # basic analysis: find
             for check in checks:
-                results = b.get_results(dbpath)
                 res = check(results)
                 if res:
                     res['benchmark'] = ":ref:`%s`" % b.get_rst_label()
@@ -1,10 +1,19 @@
-import cPickle as pickle
+import collections
 import os
 import subprocess
+import sys
+import tempfile
+import threading
+import Queue
+
+from contextlib import contextmanager
+from fnmatch import fnmatch
+from multiprocessing.pool import ThreadPool
 
 from vbench.git import GitRepo, BenchRepo, FailedToBuildError
 from vbench.db import BenchmarkDB
-from vbench.utils import multires_order, verify_benchmarks
+from vbench.utils import (multires_order, verify_benchmarks, confine_cmd,
+                          complement_cpus, read_message, write_message)
 
 from datetime import datetime
 
@@ -39,6 +48,55 @@ class BenchmarkRunner(object):
     overwrite : boolean
     dependencies : list or None
         should be list of modules visible in cwd
+    n_workers : int, default: 1
+        number of independent checkouts (each with its own build and tmp
+        directory, sharing one copy of the history) used to process
+        revisions concurrently
+    build_workers : int or None
+        how many of the checkouts may build at the same time.  None
+        means all of them.  Timing of the benchmarks is always serialized
+        across workers so results stay comparable
+    timing_cpus : str or None
+        CPU list (as understood by taskset) to pin the benchmarks process to
+    pipeline : boolean
+        build the next revision in a second checkout while the current one
+        is being timed.  Shortcut for n_workers=2, build_workers=1
+    build_nice : int or None
+        niceness for the build commands
+    build_cpus : str or None
+        CPU list to confine the builds to.  If None and timing_cpus is
+        given, builds are confined to the remaining CPUs
+    build_cache : BuildCache or None
+        cache of build artifacts shared by all the checkouts
+    compiler_cache : CompilerCache or None
+        compiler cache (ccache) to build the revisions with.  The hit
+        rates logged per build are exact only with build_workers=1
+    source_globs : dict or None
+        mapping of Benchmark.module_name to fnmatch-style globs of the
+        paths the benchmarks of that module depend on (None key serves as
+        the default for other modules).  If none of those paths changed
+        since the previously benchmarked revision, the previous result is
+        carried forward instead of running the benchmark.  With several
+        workers, a revision is not started before the revisions it might
+        carry results forward from are done
+    isolate : boolean
+        run every benchmark in its own forked process, so a crashing
+        benchmark does not take the others down
+    benchmark_timeout : float or None
+        wall-clock limit (in seconds) for a single benchmark.  Implies isolate
+    benchmark_memory_limit : int or None
+        address space limit (in bytes) for a single benchmark.  Implies
+        isolate
+    reuse_calibration : boolean, default: True
+        start timing with the number of loops chosen for the previous
+        benchmarked revision, re-calibrating only if timing has drifted
+        considerably
+    share_setup : boolean
+        execute identical setups of benchmarks only once per revision,
+        giving each benchmark a (shallow) copy of the resulting namespace
+    repo_cache_dir : str or None
+        directory to keep the index of the repository's commit log in, so
+        only new commits are read from git on a next run (see `GitRepo`)
     """
 
     def __init__(self, benchmarks, repo_path, repo_url,
@@ -50,7 +108,22 @@ class BenchmarkRunner(object):
                  module_dependencies=None,
                  always_clean=False,
                  use_blacklist=True,
-                 verify=False):
+                 verify=False,
+                 n_workers=1,
+                 build_workers=None,
+                 timing_cpus=None,
+                 pipeline=False,
+                 build_nice=None,
+                 build_cpus=None,
+                 build_cache=None,
+                 source_globs=None,
+                 isolate=False,
+                 benchmark_timeout=None,
+                 benchmark_memory_limit=None,
+                 reuse_calibration=True,
+                 share_setup=False,
+                 repo_cache_dir=None,
+                 compiler_cache=None):
         log.info("Initializing benchmark runner for %d benchmarks" % (len(benchmarks)))
         self._benchmarks = None
         self._checksums = None
@@ -65,10 +138,24 @@ class BenchmarkRunner(object):
         self.repo_path = repo_path
         self.db_path = db_path
 
-        self.repo = GitRepo(self.repo_path)
+        self.repo = GitRepo(self.repo_path, cache_dir=repo_cache_dir)
         self.db = BenchmarkDB(db_path)
 
         self.use_blacklist = use_blacklist
+        self.source_globs = source_globs
+        self.isolate = isolate
+        self.benchmark_timeout = benchmark_timeout
+        self.benchmark_memory_limit = benchmark_memory_limit
+        self.reuse_calibration = reuse_calibration
+        self.share_setup = share_setup
+        # checksum: number of loops last used
+        self._loops = {}
+
+        if pipeline:
+            n_workers = max(n_workers, 2)
+            build_workers = build_workers or 1
+        if build_cpus is None and timing_cpus is not None:
+            build_cpus = complement_cpus(timing_cpus)
 
         # where to copy the repo
         self.tmp_dir = tmp_dir
@@ -76,7 +163,37 @@ class BenchmarkRunner(object):
                                     prep_cmd,
                                     clean_cmd,
                                     always_clean=always_clean,
-                                    dependencies=module_dependencies)
+                                    dependencies=module_dependencies,
+                                    build_nice=build_nice,
+                                    build_cpus=build_cpus,
+                                    build_cache=build_cache,
+                                    compiler_cache=compiler_cache)
+        # additional isolated checkouts for parallel processing of revisions
+        self.n_workers = n_workers
+        self.bench_repos = [self.bench_repo]
+        for i in xrange(1, n_workers):
+            self.bench_repos.append(
+                BenchRepo(repo_url, '%s_w%d' % (self.tmp_dir, i), build_cmd,
+                          prep_cmd,
+                          clean_cmd,
+                          always_clean=always_clean,
+                          dependencies=module_dependencies,
+                          build_nice=build_nice,
+                          build_cpus=build_cpus,
+                          build_cache=build_cache,
+                          compiler_cache=compiler_cache,
+                          object_store=self.bench_repo.target_dir_tmp))
+        self._idle_repos = Queue.Queue()
+        for bench_repo in self.bench_repos:
+            self._idle_repos.put(bench_repo)
+        # position in CLEAN_LEVELS of the next hard clean of a checkout,
+        # raised while hard cleaning does not get rid of the failures
+        self._clean_levels = {}
+
+        self.timing_cpus = timing_cpus
+        self._build_slots = threading.BoundedSemaphore(
+            build_workers or n_workers)
+        self._timing_lock = threading.Lock()
 
         self.benchmarks = benchmarks
 
@@ -105,18 +222,27 @@ class BenchmarkRunner(object):
         revisions = self._get_revisions_to_run()
         ran_revisions = []
         log.info("Running benchmarks for %d revisions" % (len(revisions),))
+        if self.reuse_calibration:
+            self._loops = self.db.get_latest_ncalls()
         # get the current black list (might be a different one on a next .run())
         blacklist = self.blacklist
-        for rev in revisions:
-            if self.use_blacklist and rev in blacklist:
-                log.warn('Skipping blacklisted %s' % rev)
-                continue
-
-            try:
-                any_succeeded, n_active = self._run_and_write_results(rev)
-            except FailedToBuildError, e:
-                self._blacklist_rev(rev, msg=str(e))
+        if self.use_blacklist:
+            for rev in revisions:
+                if rev in blacklist:
+                    log.warn('Skipping blacklisted %s' % rev)
+            revisions = [rev for rev in revisions if rev not in blacklist]
+
+        # results of these would be rolled up again
+        until = self.db.get_downsampled_until()
+        if until is not None:
+            revisions = [rev for rev in revisions
+                         if self.repo.timestamps[rev] >= until]
+
+        for rev, outcome in self._run_revisions(revisions):
+            if isinstance(outcome, FailedToBuildError):
+                self._blacklist_rev(rev, msg=str(outcome))
                 continue
+            any_succeeded, n_active = outcome
 
             # All the rerunning below somewhat obscures the destiny of
             # ran_revisions. TODO: make it clear(er)
@@ -128,13 +254,15 @@ class BenchmarkRunner(object):
                           n_active)
                 if not any_succeeded:
                     # Give them a second chance
-                    self.bench_repo.hard_clean()
-                    try:
-                        any_succeeded2, n_active2 = self._run_and_write_results(rev)
-                    except FailedToBuildError, e:
-                        log.warn("Failed to build upon 2nd attempt to benchmark, "
-                                 "verify build infrastructure. Skipping for now: %s" % e)
-                        continue
+                    with self._lease_bench_repo() as bench_repo:
+                        self._hard_clean(bench_repo)
+                        try:
+                            any_succeeded2, n_active2 = \
+                                self._run_and_write_results(rev, bench_repo)
+                        except FailedToBuildError, e:
+                            log.warn("Failed to build upon 2nd attempt to benchmark, "
+                                     "verify build infrastructure. Skipping for now: %s" % e)
+                            continue
 
                     assert(n_active == n_active2,
                            "Since not any_succeeded, number of benchmarks should remain the same")
@@ -142,8 +270,133 @@ class BenchmarkRunner(object):
                     # wasting our time
                     if (not any_succeeded2 and n_active > 5):
                         self._blacklist_rev(rev, "None benchmark among %d has succeeded" % n_active)
+        self._log_clean_stats()
         return ran_revisions
 
+    def _hard_clean(self, bench_repo):
+        """Hard clean the checkout, more thoroughly than the last time if
+        that has not helped (see `_run_revision`)"""
+        levels = bench_repo.CLEAN_LEVELS
+        level = bench_repo.hard_clean(
+            levels[self._clean_levels.get(bench_repo, 0)])
+        self._clean_levels[bench_repo] = min(levels.index(level) + 1,
+                                             len(levels) - 1)
+
+    def _log_clean_stats(self):
+        stats = {}
+        for bench_repo in self.bench_repos:
+            for level, x in bench_repo.clean_stats.iteritems():
+                count, seconds = stats.get(level, (0, 0))
+                stats[level] = (count + x['count'], seconds + x['time'])
+        if any(count for count, _ in stats.values()):
+            log.info("Hard cleans: " + ', '.join(
+                "%s %d (%.1f sec)" % (level, stats[level][0], stats[level][1])
+                for level in BenchRepo.CLEAN_LEVELS))
+
+    def _run_revisions(self, revisions):
+        """Run and write results for revisions, yielding (rev, outcome)
+
+        outcome is either (any_succeeded, n_active) or the FailedToBuildError
+        raised while switching to the revision.  Outcomes are yielded in the
+        order of `revisions` even when several workers are in use.
+        """
+        if self.n_workers <= 1:
+            for rev in revisions:
+                try:
+                    with self._lease_bench_repo() as bench_repo:
+                        outcome = self._run_and_write_results(rev, bench_repo)
+                except FailedToBuildError, e:
+                    outcome = e
+                yield rev, outcome
+            return
+
+        # only the building and timing happens in the worker threads, while
+        # all the bookkeeping in the DB is done here (results of a revision
+        # in one go, as in serial mode) as the workers report
+        # (rev, checksum, result) for every finished benchmark and
+        # (rev, None, outcome) for a finished revision, where outcome is
+        # None, FailedToBuildError or exc_info of any other exception
+        events = Queue.Queue()
+        pending = collections.deque(revisions)
+        running = {}        # rev: (results so far, n_active)
+        outcomes = {}
+        order = list(revisions)
+        # revisions the next pending one should wait for, so results could
+        # be carried forward from them (see _carry_forward)
+        waits_for = None
+        pool = ThreadPool(self.n_workers)
+        try:
+            while order:
+                while pending and len(running) < self.n_workers:
+                    if waits_for is None:
+                        next_rev = pending[0]
+                        waits_for = [r for r in running
+                                     if self._can_carry_forward(next_rev, r)]
+                    if any(r in running for r in waits_for):
+                        break
+                    waits_for = None
+                    rev = pending.popleft()
+                    benchmarks = self._get_benchmarks_for_rev(rev)
+                    if not benchmarks:
+                        log.info('No benchmarks need running at %s' % rev)
+                        outcomes[rev] = (False, 0)
+                        continue
+                    running[rev] = ({}, len(benchmarks))
+                    pool.apply_async(self._run_job,
+                                     ((rev, benchmarks, events),))
+
+                # outcomes are yielded in order of revisions
+                while order and order[0] in outcomes:
+                    rev = order.pop(0)
+                    yield rev, outcomes.pop(rev)
+                if not running:
+                    continue
+
+                rev, checksum, result = events.get()
+                if checksum is not None:
+                    running[rev][0][checksum] = result
+                    continue
+                # whatever has finished gets written even if running the
+                # rest failed
+                results, n_active = running.pop(rev)
+                any_succeeded = self._write_results(rev, results)
+                if isinstance(result, FailedToBuildError):
+                    outcomes[rev] = result
+                elif result is not None:
+                    # fail the same way as running in the main thread would
+                    raise result[0], result[1], result[2]
+                else:
+                    outcomes[rev] = (any_succeeded, n_active)
+        finally:
+            pool.terminate()
+
+    def _run_job(self, job):
+        """Run benchmarks of a revision in a worker thread of `_run_revisions`
+        """
+        rev, benchmarks, events = job
+        on_result = lambda checksum, result: events.put((rev, checksum, result))
+        try:
+            with self._lease_bench_repo() as bench_repo:
+                self._run_revision(rev, benchmarks, bench_repo,
+                                   on_result=on_result)
+        except FailedToBuildError, e:
+            events.put((rev, None, e))
+        except Exception:
+            # to be re-raised by the main thread, which would be left
+            # waiting for the revision otherwise
+            events.put((rev, None, sys.exc_info()))
+        else:
+            events.put((rev, None, None))
+
+    @contextmanager
+    def _lease_bench_repo(self):
+        """Take an idle checkout for exclusive use, blocking until available"""
+        bench_repo = self._idle_repos.get()
+        try:
+            yield bench_repo
+        finally:
+            self._idle_repos.put(bench_repo)
+
     def verify_benchmarks(self, rev=None):
         """Verify contained benchmarks
         """
@@ -151,7 +404,7 @@ class BenchmarkRunner(object):
             raise NotImplementedError("Verification is not yet implemented against a preset revision")
         return verify_benchmarks(self.benchmarks)
 
-    def _run_and_write_results(self, rev):
+    def _run_and_write_results(self, rev, bench_repo=None):
         """
         Returns True if any runs succeeded
         """
@@ -161,35 +414,62 @@ class BenchmarkRunner(object):
             log.info('No benchmarks need running at %s' % rev)
             return False, 0
 
-        any_succeeded = False
+        # collected as they arrive, so whatever has finished gets written
+        # even if running the rest fails
+        results = {}
+        try:
+            self._run_revision(rev, active_benchmarks, bench_repo,
+                               on_result=results.__setitem__)
+        finally:
+            any_succeeded = self._write_results(rev, results)
+        return any_succeeded, len(active_benchmarks)
 
-        results = self._run_revision(rev, active_benchmarks)
+    def _write_results(self, rev, results):
+        """Write all results of a revision in one go
 
+        Returns True if any runs succeeded
+        """
+        any_succeeded = False
+        timestamp = self.repo.timestamps[rev]
+        rows = []
         for checksum, timing in results.iteritems():
-            timestamp = self.repo.timestamps[rev]
-
-            any_succeeded = any_succeeded or 'timing' in timing
-
-            self.db.write_result(checksum, rev, timestamp,
-                                 timing.get('loops'),
-                                 timing.get('timing'),
-                                 timing.get('traceback'))
-
-        return any_succeeded, len(active_benchmarks)
+            if 'timing' in timing:
+                any_succeeded = True
+                self._loops[checksum] = timing['loops']
+            rows.append(dict(checksum=checksum, revision=rev,
+                             timestamp=timestamp,
+                             ncalls=timing.get('loops'),
+                             timing=timing.get('timing'),
+                             traceback=timing.get('traceback'),
+                             samples=timing.get('samples')))
+        self.db.write_results(rows)
+
+        return any_succeeded
 
     def _register_benchmarks(self):
         log.info('Getting benchmarks')
         ex_benchmarks = self.db.get_benchmarks()
         db_checksums = set(ex_benchmarks.index)
         log.info("Registering %d benchmarks" % len(ex_benchmarks))
+        new_benchmarks = []
         for bm in self.benchmarks:
-            if bm.checksum in db_checksums:
-                self.db.update_name(bm)
-            else:
+            if bm.checksum not in db_checksums:
                 log.info('Writing new benchmark %s, %s' % (bm.name, bm.checksum))
-                self.db.write_benchmark(bm)
+                new_benchmarks.append(bm)
+        self.db.update_names([bm for bm in self.benchmarks
+                              if bm.checksum in db_checksums])
+        self.db.write_benchmarks(new_benchmarks)
+
+    def _run_revision(self, rev, benchmarks, bench_repo=None, on_result=None):
+        """Build revision and run benchmarks on it
+
+        on_result : callable or None
+          called with (checksum, result) as soon as each benchmark finishes
 
-    def _run_revision(self, rev, benchmarks):
+        Returns dict of results per checksum
+        """
+        if bench_repo is None:
+            bench_repo = self.bench_repo
         # for enhanced logging -- get information about the revision:
         rev_info = self.repo.get_commit_info(rev)
         rev_s = str(rev)
@@ -200,48 +480,111 @@ class BenchmarkRunner(object):
         for bm in benchmarks:
             log.debug(bm.name)
 
-        self.bench_repo.switch_to_revision(rev)
-
-        pickle_path = os.path.join(self.tmp_dir, 'benchmarks.pickle')
-        results_path = os.path.join(self.tmp_dir, 'results.pickle')
-        if os.path.exists(results_path):
-            os.remove(results_path)
-        pickle.dump(benchmarks, open(pickle_path, 'w'))
-
-        # run the process
-        cmd = 'python vb_run_benchmarks.py %s %s' % (pickle_path, results_path)
-        log.debug("CMD: %s" % cmd)
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                shell=True,
-                                cwd=self.tmp_dir)
-        stdout, stderr = proc.communicate()
+        with self._build_slots:
+            bench_repo.switch_to_revision(rev)
 
-        if stdout:
-            log.debug('stdout: %s' % stdout)
-
-        if proc.returncode:
-            log.warn("vb_run_benchmark.py returned with non-0 code: %d" % proc.returncode)
+        # only a single revision gets timed at a time
+        with self._timing_lock:
+            results, stderr = self._run_benchmarks(benchmarks,
+                                                   bench_repo.target_dir,
+                                                   on_result)
 
+        broken = False
         if stderr:
             log.warn("stderr: %s" % stderr)
-            if ("object has no attribute" in stderr or
-                'ImportError' in stderr):
-                log.warn('HARD CLEANING!')
-                self.bench_repo.hard_clean()
+            broken = ("object has no attribute" in stderr or
+                      'ImportError' in stderr)
+        if broken:
+            log.warn('HARD CLEANING!')
+            self._hard_clean(bench_repo)
+        else:
+            # the last hard clean (if any) did its job
+            self._clean_levels.pop(bench_repo, None)
 
-        if not os.path.exists(results_path):
+        if not results:
             log.warn('Failed for revision %s' % rev)
-            return {}
 
-        results = pickle.load(open(results_path, 'r'))
+        return results
+
+    def _run_benchmarks(self, benchmarks, work_dir, on_result=None):
+        """Stream benchmarks through a vb_run_benchmarks.py worker process
 
-        try:
-            os.remove(pickle_path)
-        except OSError:
-            pass
+        Benchmarks are sent one at a time and results are received as soon
+        as each one finishes.  If the worker dies, only the benchmark in
+        flight is lost: a new worker is started for the remaining ones.
 
-        return results
+        Returns (results, stderr)
+        """
+        cmd = 'python vb_run_benchmarks.py'
+        if self.isolate:
+            cmd += ' --isolate'
+        if self.benchmark_timeout:
+            cmd += ' --timeout %g' % self.benchmark_timeout
+        if self.benchmark_memory_limit:
+            cmd += ' --memory-limit %d' % self.benchmark_memory_limit
+        pending = list(benchmarks)
+        if self.share_setup:
+            cmd += ' --share-setup'
+            # so identical setups follow each other
+            pending.sort(key=lambda bm: bm.setup)
+        cmd = confine_cmd(cmd, cpus=self.timing_cpus)
+        results = {}
+        stderrs = []
+        while pending:
+            log.debug("CMD: %s" % cmd)
+            stderr_file = tempfile.TemporaryFile()
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=stderr_file,
+                                    shell=True,
+                                    cwd=work_dir)
+            started = False
+            try:
+                # worker announces itself once it is ready to run benchmarks
+                read_message(proc.stdout)
+                started = True
+                while pending:
+                    bm = pending[0]
+                    run_kwargs = {}
+                    if self.reuse_calibration:
+                        run_kwargs['loops_hint'] = self._loops.get(bm.checksum)
+                    write_message(proc.stdin, (bm, run_kwargs))
+                    checksum, result = read_message(proc.stdout)
+                    pending.pop(0)
+                    results[checksum] = result
+                    if not result['succeeded']:
+                        log.debug("%s failed in stage %s:\n%s"
+                                  % (bm, result.get('stage', 'UNKNOWN'),
+                                     result.get('traceback', 'UNKNOWN')))
+                    if on_result is not None:
+                        on_result(checksum, result)
+                write_message(proc.stdin, None)
+            except (EOFError, IOError):
+                if started:
+                    # worker died -- drop the benchmark it was running
+                    log.warn("Benchmark worker died while running %s"
+                             % pending.pop(0))
+            finally:
+                proc.stdin.close()
+                proc.stdout.close()
+                proc.wait()
+
+            stdout_path = os.path.join(work_dir, 'vb_stdout.log')
+            if os.path.exists(stdout_path):
+                stdout = open(stdout_path).read()
+                if stdout:
+                    log.debug('stdout: %s' % stdout)
+            stderr_file.seek(0)
+            stderrs.append(stderr_file.read())
+
+            if proc.returncode:
+                log.warn("vb_run_benchmark.py returned with non-0 code: %d"
+                         % proc.returncode)
+            if not started:
+                # no point to start it again
+                break
+
+        return results, ''.join(stderrs)
 
     def _get_benchmarks_for_rev(self, rev):
         existing_results = self.db.get_rev_results(rev)
@@ -249,15 +592,73 @@ class BenchmarkRunner(object):
 
         timestamp = self.repo.timestamps[rev]
 
+        # latest results to carry forward, fetched only once needed
+        latest = None
+        carried = []
         for b in self.benchmarks:
             if b.start_date is not None and b.start_date > timestamp:
                 continue
 
-            if b.checksum not in existing_results:
-                need_to_run.append(b)
+            if b.checksum in existing_results:
+                continue
+
+            if self._get_source_globs(b):
+                if latest is None:
+                    latest = self.db.get_latest_results(timestamp)
+                row = self._carry_forward(rev, b, latest.get(b.checksum))
+                if row is not None:
+                    carried.append(row)
+                    continue
+
+            need_to_run.append(b)
 
+        self.db.write_results(carried)
         return need_to_run
 
+    def _get_source_globs(self, bm):
+        """Return globs of the sources benchmark bm depends on, or None"""
+        if not self.source_globs:
+            return None
+        return self.source_globs.get(bm.module_name,
+                                     self.source_globs.get(None))
+
+    def _sources_changed(self, rev, prev_rev, globs):
+        changed = self.repo.changed_paths(rev, prev_rev)
+        return any(fnmatch(path, g) for path in changed for g in globs)
+
+    def _carry_forward(self, rev, bm, prev):
+        """Copy result of the previous benchmarked revision if sources didn't change
+
+        prev : row or None
+          latest successful result of bm before rev
+
+        Returns result row to be written for rev, or None
+        """
+        globs = self._get_source_globs(bm)
+        if not globs or prev is None:
+            return None
+        if self._sources_changed(rev, prev.revision, globs):
+            return None
+
+        log.debug("Carrying forward result of %s from %s to %s"
+                  % (bm.name, prev.revision, rev))
+        return dict(checksum=bm.checksum, revision=rev,
+                    timestamp=self.repo.timestamps[rev],
+                    ncalls=prev.ncalls, timing=prev.timing,
+                    carried_from=prev.revision)
+
+    def _can_carry_forward(self, rev, prev_rev):
+        """Whether some results of prev_rev could be carried forward to rev"""
+        if not self.source_globs:
+            return False
+        if self.repo.timestamps[prev_rev] >= self.repo.timestamps[rev]:
+            return False
+        for bm in self.benchmarks:
+            globs = self._get_source_globs(bm)
+            if globs and not self._sources_changed(rev, prev_rev, globs):
+                return True
+        return False
+
     def _get_revisions_to_run(self):
 
         # TODO generalize someday to other vcs...git only for now
@@ -1,30 +1,73 @@
+"""Worker running benchmarks streamed by the BenchmarkRunner
+
+(Benchmark, run_kwargs) pairs are read one at a time from stdin as
+length-prefixed pickles (see vbench.utils.write_message) and (checksum,
+result) pairs are written back to stdout as each of them finishes ('ready'
+is sent upon start).  None or the end of input stop the worker.  Whatever
+benchmarks print to stdout goes to vb_stdout.log.
+
+With --isolate (implied by --timeout and --memory-limit) every benchmark
+runs in its own forked process.  With --share-setup identical setups of
+consecutive benchmarks are executed only once.
+"""
+import os
 import sys
-import cPickle as pickle
 
-if len(sys.argv) != 3:
-    print('Usage: script.py input output')
-    sys.exit()
+from optparse import OptionParser
+
+parser = OptionParser()
+parser.add_option('--isolate', action='store_true', default=False,
+                  help='run every benchmark in a forked process')
+parser.add_option('--share-setup', action='store_true', default=False,
+                  help='execute identical setups only once')
+parser.add_option('--timeout', type='float',
+                  help='wall-clock limit (seconds) per benchmark')
+parser.add_option('--memory-limit', type='int',
+                  help='address space limit (bytes) per benchmark')
+opts, args = parser.parse_args()
+isolate = opts.isolate or opts.timeout or opts.memory_limit
+
+# keep the real stdout for the results and redirect everything else
+_results_out = os.fdopen(os.dup(1), 'wb')
+_stdout_log = open('vb_stdout.log', 'w')
+os.dup2(_stdout_log.fileno(), 1)
+
+from vbench.benchmark import run_isolated, SharedSetups
+from vbench.utils import read_message, write_message
+
+# let the runner know we are ready
+write_message(_results_out, 'ready')
 
-in_path, out_path = sys.argv[1:]
-benchmarks = pickle.load(open(in_path))
+shared_setups = SharedSetups() if opts.share_setup else None
 
-results = {}
 errors = 0
-for bmk in benchmarks:
+while True:
     try:
-        res = bmk.run()
-    except Exception, e:
-        errors += 1
-        print("E: Got an exception while running %s\n%s" % (bmk, e))
-        continue
+        msg = read_message(sys.stdin)
+    except EOFError:
+        break
+    if msg is None:
+        break
+    bmk, run_kwargs = msg
+    if shared_setups is not None:
+        run_kwargs['shared_setups'] = shared_setups
 
-    results[bmk.checksum] = res
+    try:
+        if isolate:
+            res = run_isolated(bmk, timeout=opts.timeout,
+                               memory_limit=opts.memory_limit, **run_kwargs)
+        else:
+            res = bmk.run(**run_kwargs)
+    except Exception, e:
+        import traceback
+        res = {'succeeded': False,
+               'stage': 'run',
+               'traceback': traceback.format_exc()}
 
     if not res['succeeded']:
         errors += 1
-        print("I: Failed to succeed with %s in stage %s."
-               % (bmk, res.get('stage', 'UNKNOWN')))
-        print(res.get('traceback', 'Traceback: UNKNOWN'))
 
-benchmarks = pickle.dump(results, open(out_path, 'w'))
+    write_message(_results_out, (bmk.checksum, res))
+
+sys.stdout.flush()
 sys.exit(errors)
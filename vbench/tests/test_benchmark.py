@@ -0,0 +1,136 @@
+import time
+
+from nose.tools import eq_, ok_
+
+from numpy.testing import assert_almost_equal
+
+from vbench.benchmark import Benchmark, SharedSetups, run_isolated, \
+     relative_ci_halfwidth, _MAX_REPEAT
+
+
+def test_run_isolated():
+    bm = Benchmark('x + 1', 'x = 1', name='bm_add', ncalls=10, repeat=2)
+    result = run_isolated(bm)
+    ok_(result['succeeded'])
+    eq_(result['loops'], 10)
+
+
+def test_run_isolated_timeout():
+    bm = Benchmark('time.sleep(5)', 'import time', name='bm_sleep',
+                   ncalls=1, repeat=1)
+    result = run_isolated(bm, timeout=0.2)
+    ok_(not result['succeeded'])
+    eq_(result['stage'], 'timeout')
+
+
+def test_run_isolated_oom():
+    bm = Benchmark('s = " " * (2 ** 30)', 'pass', name='bm_alloc',
+                   ncalls=1, repeat=1)
+    result = run_isolated(bm, memory_limit=256 * 2 ** 20)
+    ok_(not result['succeeded'])
+    eq_(result['stage'], 'oom')
+
+
+def test_run_isolated_crash():
+    bm = Benchmark('os._exit(3)', 'import os', name='bm_exit',
+                   ncalls=1, repeat=1)
+    result = run_isolated(bm)
+    ok_(not result['succeeded'])
+    eq_(result['stage'], 'crash')
+
+
+def test_run_isolated_timeout_shared_setup():
+    # setup is subject to the timeout even if shared
+    bm = Benchmark('pass', 'import time; time.sleep(5)', name='bm_setup',
+                   ncalls=1, repeat=1)
+    start = time.time()
+    result = run_isolated(bm, timeout=0.2, shared_setups=SharedSetups())
+    ok_(time.time() - start < 2)
+    eq_(result['stage'], 'timeout')
+
+    # and so is to the memory limit
+    bm = Benchmark('pass', 's = " " * (2 ** 30)', name='bm_setup_alloc',
+                   ncalls=1, repeat=1)
+    result = run_isolated(bm, memory_limit=256 * 2 ** 20,
+                          shared_setups=SharedSetups())
+    ok_(not result['succeeded'])
+    eq_(result['stage'], 'oom')
+
+
+def test_run_isolated_segfault():
+    # not an oom even with limited memory
+    bm = Benchmark('os.kill(os.getpid(), signal.SIGSEGV)', 'import os, signal',
+                   name='bm_segv', ncalls=1, repeat=1)
+    result = run_isolated(bm, memory_limit=256 * 2 ** 20)
+    ok_(not result['succeeded'])
+    eq_(result['stage'], 'crash')
+
+
+def test_relative_ci_halfwidth():
+    ok_(relative_ci_halfwidth([1.0]) == float('inf'))
+    eq_(relative_ci_halfwidth([2.0, 2.0, 2.0]), 0)
+    # mean 2, std 1, n 3 => 4.303 / sqrt(3) / 2
+    assert_almost_equal(relative_ci_halfwidth([1.0, 2.0, 3.0]),
+                        4.303 / 3 ** 0.5 / 2)
+
+
+def test_adaptive_repeat():
+    bm = Benchmark('sum(x)', 'x = range(10000)', name='bm_sum', ncalls=20,
+                   repeat=2, target_precision=1e-12, time_budget=0.2)
+    result = bm.run()
+    ok_(result['succeeded'])
+    ok_(result['repeat'] > 2)
+    eq_(len(result['samples']), result['repeat'])
+    ok_(result['precision'] > 1e-12)
+
+    result = bm.run(adaptive=False)
+    eq_(result['repeat'], 2)
+
+
+def test_adaptive_repeat_unlimited_budget():
+    # unattainable precision without a time budget still terminates
+    bm = Benchmark('x.append(1); time.sleep(1e-4 * (len(x) % 2))',
+                   'import time; x = []', name='bm_sleep', ncalls=1,
+                   repeat=2, target_precision=1e-12, time_budget=None)
+    result = bm.run()
+    ok_(result['succeeded'])
+    eq_(result['repeat'], _MAX_REPEAT)
+
+
+def test_loops_hint():
+    bm = Benchmark('time.sleep(0.06)', 'import time', name='bm_sleep',
+                   repeat=1)
+    result = bm.run(loops_hint=1)
+    eq_(result['loops'], 1)
+    ok_(not result['calibrated'])
+
+    # too few loops for a fast statement -- calibrate
+    bm = Benchmark('x + 1', 'x = 1', name='bm_add', repeat=1)
+    result = bm.run(loops_hint=1)
+    ok_(result['loops'] > 1)
+    ok_(result['calibrated'])
+
+
+_setup_calls = []
+
+def test_shared_setups():
+    setup = ("import vbench.tests.test_benchmark as t\n"
+             "t._setup_calls.append(1)\n"
+             "x = 1")
+    bm1 = Benchmark('y = x + 1', setup, name='bm1', ncalls=1, repeat=1)
+    bm2 = Benchmark('assert "y" not in dir()', setup, name='bm2',
+                    ncalls=1, repeat=1)
+    bm3 = Benchmark('x + 3', setup, cleanup='del x', name='bm3',
+                    ncalls=1, repeat=1)
+    shared = SharedSetups()
+    del _setup_calls[:]
+    for bm in (bm1, bm2):
+        ok_(bm.run(shared_setups=shared)['succeeded'])
+    eq_(len(_setup_calls), 1)
+    # benchmarks with cleanup do not share
+    ok_(bm3.run(shared_setups=shared)['succeeded'])
+    eq_(len(_setup_calls), 2)
+    # setup gets executed in the parent
+    ok_(run_isolated(bm1, shared_setups=shared)['succeeded'])
+    ok_(run_isolated(bm2, shared_setups=shared)['succeeded'])
+    eq_(len(_setup_calls), 2)
@@ -1,22 +1,393 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
 import unittest
 
-# from gitbench.db import BenchmarkDB  # FIXME: test is actually empty
+from datetime import datetime
+
+import numpy as np
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+from vbench.benchmark import Benchmark
+from vbench.db import BenchmarkDB, ColumnarDB, _delete_keys, \
+     _postgresql_upsert
 
 
 class TestBenchmarkDB(unittest.TestCase):
 
-    test_path = '__test__.db'
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='vb_test_db')
+        self.test_path = os.path.join(self.tmp_dir, '__test__.db')
+        self.db = BenchmarkDB(self.test_path)
+        self.bm = Benchmark('x + 1', 'x = 1', name='bm_add')
+        self.db.write_benchmark(self.bm)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write_result(self):
+        self.db.write_result(self.bm.checksum, 'abc', datetime(2012, 1, 1),
+                             10, 1.5)
+        self.db.write_result(self.bm.checksum, 'abd', datetime(2012, 1, 2),
+                             10, 1.2, carried_from='abc')
+        results = self.db.get_benchmark_results(self.bm.checksum)
+        self.assertEqual(list(results['revision']), ['abc', 'abd'])
+        self.assertEqual(list(results['timing']), [1.5, 1.2])
+        self.assertEqual(results['carried_from'][-1], 'abc')
+        self.assertEqual(set(self.db.get_rev_results('abc')),
+                         set([self.bm.checksum]))
+
+    def test_bulk_writes(self):
+        bms = [Benchmark('x * %d' % i, 'x = 1', name='bm_%d' % i)
+               for i in range(3)]
+        self.db.write_benchmarks(bms)
+        bms[0].name = 'renamed'
+        self.db.update_names(bms[:1])
+        names = self.db.get_benchmarks()['name']
+        self.assertEqual(names[bms[0].checksum], 'renamed')
+        self.assertEqual(names[bms[1].checksum], 'bm_1')
+
+        self.db.write_results([
+            dict(checksum=bm.checksum, revision='abc',
+                 timestamp=datetime(2012, 1, 1), ncalls=10, timing=1.0 + i,
+                 samples=[1.0 + i, 2.0 + i])
+            for i, bm in enumerate(bms)]
+            + [dict(checksum=self.bm.checksum, revision='abc',
+                    timestamp=datetime(2012, 1, 1), traceback='Traceback')])
+        self.assertEqual(len(self.db.get_rev_results('abc')), 4)
+        self.assertEqual(list(self.db.get_samples(bms[2].checksum)['abc']),
+                         [3.0, 4.0])
+        self.assertEqual(self.db.get_samples(self.bm.checksum), {})
+
+    def test_get_all_results(self):
+        other = Benchmark('x + 2', 'x = 1', name='bm_add2')
+        self.db.write_benchmark(other)
+        self.db.write_result(self.bm.checksum, 'abd', datetime(2012, 1, 2),
+                             10, 1.2)
+        self.db.write_result(self.bm.checksum, 'abc', datetime(2012, 1, 1),
+                             10, 1.5)
+        self.db.write_result(other.checksum, 'abd', datetime(2012, 1, 2),
+                             None, None, traceback='Traceback')
+        self.db.write_result(other.checksum, 'abe', datetime(2012, 1, 3),
+                             10, 0.5)
+
+        all_results = self.db.get_all_results()
+        self.assertEqual(list(all_results.timings.index), ['abc', 'abd', 'abe'])
+        self.assertEqual(all_results.timings[self.bm.checksum]['abc'], 1.5)
+        self.assertTrue(np.isnan(all_results.timings[other.checksum]['abd']))
+        self.assertEqual(all_results.tracebacks,
+                         {other.checksum: {'abd': 'Traceback'}})
+
+        for checksum in (self.bm.checksum, other.checksum):
+            expected = self.db.get_benchmark_results(checksum)
+            results = all_results.get_benchmark_results(checksum)
+            self.assertEqual(list(results.index), list(expected.index))
+            for col in ('revision', 'timing', 'traceback'):
+                self.assertEqual(list(results[col].fillna(-1)),
+                                 list(expected[col].fillna(-1)))
+
+        all_results = self.db.get_all_results([other.checksum],
+                                              since=datetime(2012, 1, 3))
+        self.assertEqual(list(all_results.timings.columns), [other.checksum])
+        self.assertEqual(list(all_results.timings.index), ['abe'])
+        self.assertEqual(
+            len(all_results.get_benchmark_results(self.bm.checksum)), 0)
+        self.assertEqual(len(self.db.get_all_results([]).timings), 0)
+
+    def test_get_latest_ncalls(self):
+        other = Benchmark('x + 2', 'x = 1', name='bm_add2')
+        self.db.write_benchmark(other)
+        self.assertEqual(self.db.get_latest_ncalls(), {})
+        self.db.write_result(self.bm.checksum, 'abc', datetime(2012, 1, 1),
+                             10, 1.5)
+        self.db.write_result(self.bm.checksum, 'abd', datetime(2012, 1, 2),
+                             100, 1.2)
+        self.db.write_result(self.bm.checksum, 'abe', datetime(2012, 1, 3),
+                             None, None, traceback='Traceback')
+        self.db.write_result(other.checksum, 'abc', datetime(2012, 1, 1),
+                             1000, 0.1)
+        self.assertEqual(self.db.get_latest_ncalls(),
+                         {self.bm.checksum: 100, other.checksum: 1000})
+
+    def test_samples(self):
+        self.db.write_result(self.bm.checksum, 'abc', datetime(2012, 1, 1),
+                             10, 1.0, samples=[1.0, 2.0, 3.0, 6.0])
+        self.db.write_result(self.bm.checksum, 'abd', datetime(2012, 1, 2),
+                             None, None, traceback='Traceback')
+        samples = self.db.get_samples(self.bm.checksum)
+        self.assertEqual(list(samples['abc']), [1.0, 2.0, 3.0, 6.0])
+        results = self.db.get_benchmark_results(self.bm.checksum, stats=True)
+        abc = results.ix[0]
+        self.assertEqual(abc['mean'], 3.0)
+        self.assertEqual(abc['median'], 2.5)
+        self.assertAlmostEqual(abc['std'], (14 / 3.) ** 0.5)
+        self.assertEqual(abc['min'], 1.0)
+        self.assertEqual(abc['nsamples'], 4)
+        self.assertTrue(np.isnan(results['mean'][1]))
+
+        self.db.delete_rev_results('abc')
+        self.assertEqual(self.db.get_samples(self.bm.checksum), {})
+        results = self.db.get_benchmark_results(self.bm.checksum, stats=True)
+        self.assertEqual(list(results['revision']), ['abd'])
+
+    def test_upgrade_tables(self):
+        conn = sqlite3.connect(self.test_path)
+        conn.execute('CREATE TABLE old_results AS SELECT checksum, revision, '
+                     'timestamp, ncalls, timing, traceback FROM results')
+        conn.execute('DROP TABLE results')
+        conn.execute('ALTER TABLE old_results RENAME TO results')
+        conn.commit()
+        conn.close()
+
+        db = BenchmarkDB(self.test_path)
+        db.write_result(self.bm.checksum, 'abc', datetime(2012, 1, 1),
+                        10, 1.5, carried_from='abb')
+        results = db.get_benchmark_results(self.bm.checksum)
+        self.assertEqual(list(results['carried_from']), ['abb'])
+
+        conn = sqlite3.connect(self.test_path)
+        indexes = set(x[0] for x in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='index' "
+            "AND tbl_name='results'"))
+        self.assertTrue('ix_results_revision' in indexes)
+        self.assertTrue('ix_results_checksum_timestamp' in indexes)
+        self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0],
+                         'wal')
+        conn.close()
+
+    def test_query_cache(self):
+        cs = self.bm.checksum
+        self.db.write_result(cs, 'abc', datetime(2012, 1, 1), 10, 1.5)
+        first = self.db.get_benchmark_results(cs)
+        self.db.get_all_results()
+        # served from cache, bypassing the database
+        with self.db.conn.begin():
+            self.db.conn.execute(self.db._results.delete())
+        self.assertEqual(len(self.db.get_benchmark_results(cs)), 1)
+        self.assertEqual(len(self.db.get_all_results().timings), 1)
+
+        # writes through the instance invalidate affected entries
+        self.db.write_result(cs, 'abd', datetime(2012, 1, 2), 10, 1.2)
+        self.assertEqual(list(self.db.get_benchmark_results(cs)['revision']),
+                         ['abd'])
+        self.assertEqual(len(self.db.get_all_results().timings), 1)
+        self.assertEqual(len(first), 1)
+
+        self.assertEqual(self.db.get_rev_blacklist(), [])
+        self.db.add_rev_blacklist('abc')
+        self.assertEqual(self.db.get_rev_blacklist(), ['abc'])
 
-    @classmethod
-    def setUpClass(cls):
-        pass
+        uncached = BenchmarkDB(self.test_path, cache_size=0)
+        self.assertEqual(len(uncached._cache._entries), 0)
+        uncached.get_benchmarks()
+        self.assertEqual(len(uncached._cache._entries), 0)
 
-    @classmethod
-    def tearDownClass(cls):
-        pass
+    def test_columnar(self):
+        other = Benchmark('x * 2', 'x = 1', name='bm_mul')
+        self.db.write_benchmark(other)
+        self.db.write_results([
+            dict(checksum=self.bm.checksum, revision='abc',
+                 timestamp=datetime(2012, 1, 1), ncalls=10, timing=1.5,
+                 samples=[1.0, 2.0]),
+            dict(checksum=other.checksum, revision='abc',
+                 timestamp=datetime(2012, 1, 1), ncalls=10, timing=2.5),
+            dict(checksum=self.bm.checksum, revision='abd',
+                 timestamp=datetime(2012, 1, 2), traceback=u'Trace\xe9',
+                 carried_from='abc'),
+        ])
+        self.db.add_rev_blacklist('abe')
+        path = os.path.join(self.tmp_dir, 'export')
+        self.db.export_columnar(path)
+
+        cdb = BenchmarkDB.get_instance(path)
+        self.assertTrue(isinstance(cdb, ColumnarDB))
+        self.assertEqual(cdb.get_rev_blacklist(), ['abe'])
+        self.assertEqual(sorted(cdb.get_benchmarks()['name']),
+                         ['bm_add', 'bm_mul'])
+
+        for stats in (False, True):
+            expected = self.db.get_benchmark_results(self.bm.checksum, stats)
+            got = cdb.get_benchmark_results(self.bm.checksum, stats)
+            self.assertEqual(list(got.columns), list(expected.columns))
+            self.assertEqual(list(got.index), list(expected.index))
+            for c in ['revision', 'ncalls', 'traceback', 'carried_from']:
+                self.assertEqual(list(got[c]), list(expected[c]))
+            self.assertEqual(list(got['timing'].fillna(-1)),
+                             list(expected['timing'].fillna(-1)))
+        self.assertEqual(cdb.get_benchmark_results('missing').shape[0], 0)
+
+        expected = self.db.get_all_results()
+        got = cdb.get_all_results()
+        self.assertTrue(got.timings.equals(expected.timings))
+        self.assertEqual(got.tracebacks, expected.tracebacks)
+        got = cdb.get_all_results([other.checksum],
+                                  since=datetime(2012, 1, 1))
+        self.assertEqual(list(got.timings.columns), [other.checksum])
+
+        imported = BenchmarkDB(os.path.join(self.tmp_dir, 'imported.db'))
+        imported.import_columnar(path)
+        imported.import_columnar(path)
+        self.assertEqual(imported.get_rev_blacklist(), ['abe'])
+        self.assertEqual(list(imported.get_samples(self.bm.checksum)['abc']),
+                         [1.0, 2.0])
+        results = imported.get_benchmark_results(self.bm.checksum)
+        self.assertEqual(list(results['revision']), ['abc', 'abd'])
+        self.assertEqual(results['traceback'][1], u'Trace\xe9')
+
+    def test_upsert(self):
+        cs = self.bm.checksum
+        self.db.write_result(cs, 'abc', datetime(2012, 1, 1), 10, 1.5,
+                             samples=[1.5, 2.0])
+        self.db.write_result(cs, 'abc', datetime(2012, 1, 1), 20, 1.2,
+                             samples=[1.2])
+        results = self.db.get_benchmark_results(cs)
+        self.assertEqual(list(results['timing']), [1.2])
+        self.assertEqual(list(self.db.get_samples(cs)['abc']), [1.2])
+        self.db.write_result(cs, 'abc', datetime(2012, 1, 1), None, None,
+                             traceback='Traceback')
+        self.assertEqual(self.db.get_samples(cs), {})
+        self.db.write_benchmark(self.bm)
+        self.db.add_rev_blacklist('abd')
+        self.db.add_rev_blacklist('abd')
+        self.assertEqual(self.db.get_rev_blacklist(), ['abd'])
+
+        conn = self.db.conn
+        _delete_keys(conn, self.db._results, [dict(checksum=cs,
+                                                   revision='abc')])
+        self.assertEqual(len(self.db.get_rev_results('abc')), 0)
+
+        stmt = _postgresql_upsert(self.db._results)
+        sql = str(stmt.compile(dialect=postgresql.dialect()))
+        self.assertTrue('ON CONFLICT (checksum, revision) DO UPDATE' in sql)
+        self.assertTrue('timing = excluded.timing' in sql)
+
+    def test_concurrent_writer(self):
+        db = BenchmarkDB(self.test_path, busy_timeout=0)
+        other = sqlite3.connect(self.test_path, isolation_level=None,
+                                check_same_thread=False)
+        other.execute('BEGIN IMMEDIATE')
+        threading.Timer(0.2, other.execute, ['ROLLBACK']).start()
+        db.write_result(self.bm.checksum, 'abc', datetime(2012, 1, 1),
+                        10, 1.5)
+        self.assertEqual(len(db.get_rev_results('abc')), 1)
+        other.close()
+
+        db = BenchmarkDB(self.test_path, busy_timeout=0, write_retries=0)
+        other = sqlite3.connect(self.test_path, isolation_level=None)
+        other.execute('BEGIN IMMEDIATE')
+        self.assertRaises(OperationalError, db.write_result,
+                          self.bm.checksum, 'abd', datetime(2012, 1, 1),
+                          10, 1.5)
+        other.close()
+
+    def test_reconnect(self):
+        self.db.write_result(self.bm.checksum, 'abc', datetime(2012, 1, 1),
+                             10, 1.5)
+        # as if the server closed the connection
+        self.db.conn.connection.connection.close()
+        self.db.write_result(self.bm.checksum, 'abd', datetime(2012, 1, 2),
+                             10, 1.5)
+        self.db.conn.connection.connection.close()
+        # a read fails, but the next one reconnects
+        self.assertRaises(DBAPIError, self.db.get_rev_results, 'abe')
+        self.assertEqual(len(self.db.get_rev_results('abd')), 1)
+
+    def test_downsample(self):
+        cs = self.bm.checksum
+        other = Benchmark('x * 2', 'x = 1', name='bm_mul')
+        self.db.write_benchmark(other)
+        rows = []
+        # 2012-01-02 is a Monday, two weeks of daily results
+        for day in range(14):
+            rev = 'r%02d' % day
+            rows.append(dict(checksum=cs, revision=rev,
+                             timestamp=datetime(2012, 1, 2 + day),
+                             ncalls=10, timing=float(day), samples=[1.0]))
+            rows.append(dict(checksum=other.checksum, revision=rev,
+                             timestamp=datetime(2012, 1, 2 + day),
+                             ncalls=10, timing=2.0 * day))
+        self.db.write_results(rows)
+        self.assertEqual(self.db.get_downsampled_until(), None)
+
+        # only the first week is complete
+        self.assertEqual(self.db.downsample(datetime(2012, 1, 12)), 14)
+        self.assertEqual(self.db.get_downsampled_until(), datetime(2012, 1, 9))
+        self.assertEqual(self.db.get_rev_results('r00'), {})
+        self.assertEqual(sorted(self.db.get_samples(cs)),
+                         ['r%02d' % d for d in range(7, 14)])
+
+        results = self.db.get_benchmark_results(cs)
+        self.assertEqual(len(results), 8)
+        week = results.ix[0]
+        self.assertEqual(results.index[0], datetime(2012, 1, 2))
+        self.assertEqual(week['revision'], 'r06')
+        self.assertEqual(week['timing'], 0.0)
+        self.assertEqual(week['timing_median'], 3.0)
+        self.assertEqual(week['nresults'], 7)
+        self.assertEqual(week['period'], 'W')
+        self.assertEqual(len(self.db.get_benchmark_results(
+            cs, aggregated=False)), 7)
+
+        timings = self.db.get_all_results().timings
+        self.assertEqual(list(timings.index),
+                         ['r06'] + ['r%02d' % d for d in range(7, 14)])
+        self.assertEqual(list(timings.ix['r06']), [0.0, 0.0])
+
+        # a late result for an already rolled up week is merged in
+        self.db.write_result(cs, 'x', datetime(2012, 1, 3), 10, 10.0)
+        self.assertEqual(self.db.downsample(datetime(2012, 1, 12)), 1)
+        week = self.db.get_benchmark_results(cs).ix[0]
+        self.assertEqual(week['nresults'], 8)
+        self.assertEqual(week['timing'], 0.0)
+
+    def test_downsample_failures(self):
+        cs = self.bm.checksum
+        self.db.write_result(cs, 'r00', datetime(2012, 1, 2), None, None,
+                             traceback='Trace')
+        self.assertEqual(self.db.downsample(datetime(2012, 1, 12)), 1)
+        self.assertEqual(self.db.get_rev_results('r00'), {})
+        self.assertEqual(len(self.db.get_benchmark_results(cs)), 0)
+
+    def test_columnar_aggregates(self):
+        cs = self.bm.checksum
+        self.db.write_results([
+            dict(checksum=cs, revision='r%02d' % day,
+                 timestamp=datetime(2012, 1, 2 + day), ncalls=10,
+                 timing=float(day)) for day in range(9)])
+        self.db.downsample(datetime(2012, 1, 9))
+        path = os.path.join(self.tmp_dir, 'export')
+        self.db.export_columnar(path)
+
+        cdb = BenchmarkDB.get_instance(path)
+        for aggregated in (True, False):
+            expected = self.db.get_benchmark_results(cs, aggregated=aggregated)
+            got = cdb.get_benchmark_results(cs, aggregated=aggregated)
+            self.assertEqual(list(got.columns), list(expected.columns))
+            self.assertEqual(list(got.index), list(expected.index))
+            for c in got.columns:
+                self.assertEqual(list(got[c].fillna(-1)),
+                                 list(expected[c].fillna(-1)))
+        for since in (None, datetime(2012, 1, 2), datetime(2012, 1, 3)):
+            self.assertTrue(cdb.get_all_results(since=since).timings.equals(
+                self.db.get_all_results(since=since).timings))
+
+        imported = BenchmarkDB(os.path.join(self.tmp_dir, 'imported.db'))
+        imported.import_columnar(path)
+        imported.import_columnar(path)
+        self.assertEqual(imported.get_downsampled_until(),
+                         datetime(2012, 1, 9))
+        week = imported.get_benchmark_results(cs).ix[0]
+        self.assertEqual(week['revision'], 'r06')
+        self.assertEqual(week['timing_median'], 3.0)
+        self.assertEqual(week['nresults'], 7)
 
 
 if __name__ == '__main__':
     import nose
     nose.runmodule(argv=[__file__, '-vvs', '-x', '--pdb', '--pdb-failure'],
                    exit=False)
+
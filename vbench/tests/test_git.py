@@ -0,0 +1,327 @@
+import os
+import shutil
+import subprocess
+import tempfile
+
+from datetime import datetime
+
+from nose.tools import eq_, ok_
+
+from vbench.git import BenchRepo, BuildCache, CompilerCache, GitRepo
+
+
+def _git(repo, *args):
+    subprocess.check_call(['git', '-C', repo] + list(args),
+                          stdout=open(os.devnull, 'w'))
+
+
+def _write(repo, path, content):
+    with open(os.path.join(repo, path), 'w') as f:
+        f.write(content)
+
+
+def _make_repo():
+    repo = tempfile.mkdtemp(prefix='vb_test_repo')
+    _git(repo, 'init', '-q')
+    _git(repo, 'config', 'user.name', 'Tester')
+    _git(repo, 'config', 'user.email', 'tester@example.com')
+    return repo
+
+
+def _commit(repo, message, date, **files):
+    for path, content in files.iteritems():
+        _write(repo, path, content)
+        _git(repo, 'add', path)
+    env = dict(os.environ, GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date)
+    subprocess.check_call(['git', '-C', repo, 'commit', '-q',
+                           '--allow-empty', '-m', message], env=env)
+
+
+def test_build_cache():
+    repo = _make_repo()
+    cache_dir = tempfile.mkdtemp(prefix='vb_test_cache')
+    try:
+        cache = BuildCache(cache_dir, paths=['*.c'], max_size=10)
+        _commit(repo, 'first', '2012-01-01T10:00:00', **{'ext.c': 'int x;'})
+        key1 = cache.get_key(repo, 'make')
+        ok_(not cache.restore(key1, repo))
+        _write(repo, 'ext.so', 'built')
+        cache.store(key1, repo)
+
+        # docs change -- same key
+        _commit(repo, 'doc', '2012-01-02T10:00:00', README='docs')
+        eq_(cache.get_key(repo, 'make'), key1)
+        # different build commands -- different key
+        ok_(cache.get_key(repo, 'make all') != key1)
+
+        os.unlink(os.path.join(repo, 'ext.so'))
+        ok_(cache.restore(key1, repo))
+        eq_(open(os.path.join(repo, 'ext.so')).read(), 'built')
+
+        # source change -- new key, and the old entry gets evicted
+        _commit(repo, 'src', '2012-01-03T10:00:00', **{'ext.c': 'int y;'})
+        key2 = cache.get_key(repo, 'make')
+        ok_(key2 != key1)
+        _write(repo, 'ext.so', 'built2')
+        os.utime(os.path.join(cache_dir, key1), (0, 0))
+        cache.store(key2, repo)
+        eq_(os.listdir(cache_dir), [key2])
+
+        # failing to copy the artifacts is a miss
+        os.makedirs(os.path.join(cache_dir, 'key3', 'sub'))
+        _write(cache_dir, 'key3/sub/ext.so', 'built3')
+        _write(repo, 'sub', 'not a directory')
+        ok_(not cache.restore('key3', repo))
+    finally:
+        shutil.rmtree(repo)
+        shutil.rmtree(cache_dir)
+
+
+def test_parse_commit_log():
+    repo = _make_repo()
+    try:
+        _commit(repo, 'first', '2012-01-01T10:00:00+0200', a='1')
+        _commit(repo, 'second', '2012-01-02T10:00:00+0000', a='2')
+        # same timestamp as the previous one, which gets ignored
+        _commit(repo, 'third :: with colons', '2012-01-02T10:00:00+0000',
+                a='3')
+        _git(repo, 'checkout', '-q', '-b', 'side', 'HEAD~2')
+        _commit(repo, 'side', '2012-01-03T10:00:00+0000', b='1')
+        _git(repo, 'checkout', '-q', '-')
+        _git(repo, 'merge', '-q', '--no-ff', '-m', 'merge', 'side')
+
+        grepo = GitRepo(repo)
+        # commits of the side branch are not in the mainline
+        eq_(list(grepo.messages), ['first', 'third :: with colons', 'merge'])
+        eq_(list(grepo.timestamps[:2]), [datetime(2012, 1, 1, 8),
+                                         datetime(2012, 1, 2, 10)])
+        eq_(list(grepo.shas.index[:2]), list(grepo.timestamps[:2]))
+        eq_(list(grepo.authors), ['Tester'] * 3)
+        eq_(grepo.get_commit_info(grepo.shas[0])['message'], 'first')
+        full_sha = subprocess.check_output(['git', '-C', repo, 'rev-parse',
+                                            'HEAD']).strip()
+        eq_(grepo.get_commit_info(full_sha)['message'], 'merge')
+        eq_(grepo.get_commit_info('0' * 40), None)
+
+        infos = grepo.get_commit_infos([grepo.shas[1], 'unknown', full_sha])
+        eq_(list(infos['message'][[0, 2]]), ['third :: with colons', 'merge'])
+        eq_(infos['timestamp'][0], datetime(2012, 1, 2, 10))
+        ok_(infos.ix['unknown'].isnull().all())
+    finally:
+        shutil.rmtree(repo)
+
+
+def test_commit_index():
+    repo = _make_repo()
+    cache_dir = tempfile.mkdtemp(prefix='vb_test_cache')
+    try:
+        _commit(repo, 'first', '2012-01-01T10:00:00', a='1')
+        _commit(repo, 'second', '2012-01-02T10:00:00', a='2')
+        eq_(list(GitRepo(repo, cache_dir=cache_dir).messages),
+            ['first', 'second'])
+        eq_(len(os.listdir(cache_dir)), 1)
+
+        # only the new commits are read
+        _commit(repo, 'third', '2012-01-03T10:00:00', a='3')
+        grepo = GitRepo(repo, cache_dir=cache_dir)
+        eq_(list(grepo.messages), ['first', 'second', 'third'])
+        eq_(list(grepo.shas), list(GitRepo(repo).shas))
+
+        # rewritten history is read again from scratch
+        _git(repo, 'reset', '-q', '--hard', 'HEAD~2')
+        _commit(repo, 'amended', '2012-01-04T10:00:00', a='4')
+        eq_(list(GitRepo(repo, cache_dir=cache_dir).messages),
+            ['first', 'amended'])
+        _git(repo, 'reset', '-q', '--hard', 'HEAD~1')
+        eq_(list(GitRepo(repo, cache_dir=cache_dir).messages), ['first'])
+    finally:
+        shutil.rmtree(repo)
+        shutil.rmtree(cache_dir)
+
+
+def test_churn():
+    repo = _make_repo()
+    cache_dir = tempfile.mkdtemp(prefix='vb_test_cache')
+    try:
+        _commit(repo, 'first', '2012-01-01T10:00:00', a='1\n2\n', b='1\n')
+        _commit(repo, 'second', '2012-01-01T12:00:00', a='1\n3\n',
+                **{'c.bin': '\0\1'})
+        _git(repo, 'checkout', '-q', '-b', 'side')
+        _commit(repo, 'side', '2012-01-02T10:00:00', b='1\n2\n3\n')
+        _git(repo, 'checkout', '-q', '-')
+        _git(repo, 'merge', '-q', '--no-ff', '-m', 'merge', 'side')
+
+        grepo = GitRepo(repo, cache_dir=cache_dir)
+        churn = grepo.get_churn()
+        eq_(list(churn.index), [datetime(2012, 1, 1), grepo.commit_date[-1]])
+        # merge is diffed against the mainline only
+        eq_(list(churn), [3 + 2, 2])
+        eq_(list(grepo.get_churn(omit_paths=['a'])), [1, 2])
+        eq_(list(grepo.get_churn(omit_shas=[grepo.shas[0]])), [2, 2])
+
+        by_file = grepo.get_churn_by_file()
+        eq_(sorted(zip(by_file['path'], by_file['insertions'],
+                       by_file['deletions'])),
+            [('a', 1, 1), ('a', 2, 0), ('b', 1, 0), ('b', 2, 0)])
+
+        # new commits are added to the cached churn
+        _commit(repo, 'third', '2012-01-05T10:00:00', b='1\n')
+        grepo = GitRepo(repo, cache_dir=cache_dir)
+        eq_(list(grepo.get_churn()), list(GitRepo(repo).get_churn()))
+        eq_(grepo.get_churn()[-1], 2)
+    finally:
+        shutil.rmtree(repo)
+        shutil.rmtree(cache_dir)
+
+
+def test_bench_repo_shares_objects():
+    repo = _make_repo()
+    tmp_dir = tempfile.mkdtemp(prefix='vb_test_bench')
+    try:
+        _commit(repo, 'first', '2012-01-01T10:00:00', a='1')
+        _commit(repo, 'second', '2012-01-02T10:00:00', a='2')
+        shas = GitRepo(repo).shas
+
+        target = os.path.join(tmp_dir, 'checkout')
+        bench_repo = BenchRepo(repo, target, 'true', 'true')
+        other = BenchRepo(repo, target + '_w1', 'true', 'true',
+                          object_store=bench_repo.target_dir_tmp)
+        eq_(sorted(os.listdir(tmp_dir)),
+            ['checkout', 'checkout_tmp', 'checkout_w1'])
+        for checkout in (target, target + '_w1'):
+            alternates = os.path.join(checkout, '.git', 'objects', 'info',
+                                      'alternates')
+            eq_(open(alternates).read().strip(),
+                os.path.join(target + '_tmp', '.git', 'objects'))
+
+        bench_repo.switch_to_revision(shas[0])
+        other.switch_to_revision(shas[1])
+        eq_(open(os.path.join(target, 'a')).read(), '1')
+        eq_(open(os.path.join(target + '_w1', 'a')).read(), '2')
+
+        _write(target, 'untracked', '')
+        bench_repo.hard_clean()
+        ok_(not os.path.exists(os.path.join(target, 'untracked')))
+        bench_repo.switch_to_revision(shas[0])
+        eq_(open(os.path.join(target, 'a')).read(), '1')
+    finally:
+        shutil.rmtree(repo)
+        shutil.rmtree(tmp_dir)
+
+
+def test_hard_clean_levels():
+    repo = _make_repo()
+    tmp_dir = tempfile.mkdtemp(prefix='vb_test_bench')
+    try:
+        _commit(repo, 'first', '2012-01-01T10:00:00', a='1',
+                **{'.gitignore': '*.so\n'})
+        target = os.path.join(tmp_dir, 'checkout')
+        bench_repo = BenchRepo(repo, target, 'true', 'touch prepped')
+
+        def dirty():
+            _write(target, 'a', 'modified')
+            _write(target, 'ext.so', '')
+            os.mkdir(os.path.join(target, 'build'))
+            _write(target, 'build/x.o', '')
+
+        def check():
+            eq_(sorted(os.listdir(target)),
+                ['.git', '.gitignore', 'a', 'prepped'])
+            eq_(open(os.path.join(target, 'a')).read(), '1')
+
+        for level in BenchRepo.CLEAN_LEVELS:
+            dirty()
+            eq_(bench_repo.hard_clean(level), level)
+            check()
+            eq_(bench_repo.clean_stats[level]['count'], 1)
+
+        # falls back to a more thorough level
+        shutil.rmtree(os.path.join(target, '.git'))
+        eq_(bench_repo.hard_clean('clean'), 'reclone')
+        check()
+        eq_(bench_repo.clean_stats['full']['count'], 2)
+        eq_(bench_repo.clean_stats['reclone']['count'], 2)
+    finally:
+        shutil.rmtree(repo)
+        shutil.rmtree(tmp_dir)
+
+
+def test_clean_pyc_files():
+    repo = _make_repo()
+    tmp_dir = tempfile.mkdtemp(prefix='vb_test_bench')
+    try:
+        _commit(repo, 'first', '2012-01-01T10:00:00',
+                **{'a.py': '', '.gitignore': '*.pyc\n'})
+        target = os.path.join(tmp_dir, 'checkout')
+        bench_repo = BenchRepo(repo, target, 'true', 'true')
+        os.makedirs(os.path.join(target, 'pkg', 'sub'))
+        for path in ('a.pyc', 'pkg/sub/b.pyo', 'pkg/sub/c.py', 'd.pyx'):
+            _write(target, path, '')
+        bench_repo._clean_pyc_files()
+        eq_(sorted(os.listdir(target)), ['.git', '.gitignore', 'a.py',
+                                         'd.pyx', 'pkg'])
+        eq_(os.listdir(os.path.join(target, 'pkg', 'sub')), ['c.py'])
+
+        # and within submodules
+        _git(target, '-c', 'protocol.file.allow=always', 'submodule', 'add',
+             '-q', repo, 'ext')
+        _write(target, 'ext/f.pyc', '')
+        bench_repo._clean_pyc_files()
+        eq_(sorted(os.listdir(os.path.join(target, 'ext'))),
+            ['.git', '.gitignore', 'a.py'])
+
+        # without git
+        shutil.rmtree(os.path.join(target, '.git'))
+        _write(target, 'pkg/e.pyc', '')
+        bench_repo._clean_pyc_files()
+        eq_(sorted(os.listdir(os.path.join(target, 'pkg'))), ['sub'])
+    finally:
+        shutil.rmtree(repo)
+        shutil.rmtree(tmp_dir)
+
+
+# stands in for ccache: counts a hit per compilation in $CCACHE_DIR/hits
+_FAKE_CCACHE = """#!/bin/sh
+if [ "$1" = --print-stats ]; then
+    printf 'direct_cache_hit\\t%s\\ncache_miss\\t1\\n' \\
+        $(cat $CCACHE_DIR/hits 2>/dev/null || echo 0)
+    exit
+fi
+echo $(( $(cat $CCACHE_DIR/hits 2>/dev/null || echo 0) + 1 )) > $CCACHE_DIR/hits
+echo "$@" >> $CCACHE_DIR/calls
+"""
+
+
+def test_compiler_cache():
+    repo = _make_repo()
+    tmp_dir = tempfile.mkdtemp(prefix='vb_test_bench')
+    try:
+        _commit(repo, 'first', '2012-01-01T10:00:00', **{'x.c': ''})
+        command = os.path.join(tmp_dir, 'ccache')
+        _write(tmp_dir, 'ccache', _FAKE_CCACHE)
+        os.chmod(command, 0755)
+        cache_dir = os.path.join(tmp_dir, 'cache')
+        os.mkdir(cache_dir)
+
+        cache = CompilerCache(cache_dir, max_size='1G', command=command)
+        target = os.path.join(tmp_dir, 'checkout')
+        env = cache.get_env(target)
+        eq_(env['CC'], command + ' gcc')
+        eq_(env['CXX'], command + ' g++')
+        eq_(env['CCACHE_DIR'], cache_dir)
+        eq_(env['CCACHE_MAXSIZE'], '1G')
+        eq_(env['CCACHE_BASEDIR'], target)
+        eq_(cache.get_stats(env), (0, 1))
+
+        bench_repo = BenchRepo(repo, target, '$CC -c x.c\n$CXX -c x.c',
+                               'true', compiler_cache=cache)
+        bench_repo.switch_to_revision(GitRepo(repo).shas[0])
+        eq_(open(os.path.join(cache_dir, 'calls')).read(),
+            'gcc -c x.c\ng++ -c x.c\n')
+        eq_(cache.get_stats(env), (2, 1))
+
+        eq_(CompilerCache(command=os.path.join(tmp_dir, 'missing'))
+            .get_stats(), None)
+    finally:
+        shutil.rmtree(repo)
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,150 @@
+import os
+import shutil
+import sys
+import tempfile
+
+from nose.tools import eq_, ok_, assert_raises
+
+from vbench.api import Benchmark, BenchmarkRunner
+from vbench.git import FailedToBuildError
+from vbench.tests.test_git import _commit, _git, _make_repo
+
+_PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+# fails to build only the revision which has the BROKEN file
+_BUILD = 'test ! -e BROKEN'
+
+
+class TestRunner(object):
+
+    def setUp(self):
+        # benchmarks are run by `python vb_run_benchmarks.py` in the checkout
+        self._environ = dict(os.environ)
+        os.environ['PATH'] = os.pathsep.join(
+            [os.path.dirname(sys.executable), os.environ.get('PATH', '')])
+        os.environ['PYTHONPATH'] = _PACKAGE_DIR
+        self.repo = _make_repo()
+        self.tmp_dir = tempfile.mkdtemp(prefix='vb_test_runner')
+        _commit(self.repo, 'first', '2012-01-01T10:00:00',
+                **{'mod.py': 'def f(n):\n    return sum(xrange(n))\n'})
+        _commit(self.repo, 'doc', '2012-01-02T10:00:00', README='docs')
+        _commit(self.repo, 'broken', '2012-01-03T10:00:00', BROKEN='')
+        _git(self.repo, 'rm', '-q', 'BROKEN')
+        _commit(self.repo, 'fixed', '2012-01-04T10:00:00',
+                **{'mod.py': 'def f(n):\n    return sum(range(n))\n'})
+        self.benchmarks = [
+            Benchmark('mod.f(100)', 'import mod', name='f100',
+                      module_name='m'),
+            Benchmark('mod.f(10)', 'import mod', name='f10', module_name='m')]
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self._environ)
+        shutil.rmtree(self.repo)
+        # checkouts of the workers are next to tmp_dir
+        parent, name = os.path.split(self.tmp_dir)
+        for path in os.listdir(parent):
+            if path.startswith(name):
+                shutil.rmtree(os.path.join(parent, path))
+
+    def _get_runner(self, name, **kwargs):
+        return BenchmarkRunner(self.benchmarks, self.repo, self.repo,
+                               _BUILD,
+                               os.path.join(self.tmp_dir, name + '.db'),
+                               os.path.join(self.tmp_dir, name),
+                               'true', run_option='all', **kwargs)
+
+    def _get_results(self, runner):
+        return dict((bm.name, runner.db.get_benchmark_results(
+                        bm.checksum, aggregated=False))
+                    for bm in self.benchmarks)
+
+    def test_run(self):
+        serial = self._get_runner('serial')
+        parallel = self._get_runner('parallel', n_workers=2)
+        revisions = list(serial._get_revisions_to_run())
+        eq_(len(revisions), 4)
+        broken = revisions[2]
+
+        for runner in (serial, parallel):
+            ran = runner.run()
+            # in the order of revisions and without the one failed to build
+            eq_([rev for rev, outcome in ran],
+                [rev for rev in revisions if rev != broken])
+            eq_([outcome for rev, outcome in ran], [(True, 2)] * 3)
+            eq_(runner.blacklist, set([broken]))
+
+        serial_results = self._get_results(serial)
+        parallel_results = self._get_results(parallel)
+        for bm in self.benchmarks:
+            eq_(list(serial_results[bm.name].revision),
+                list(parallel_results[bm.name].revision))
+            ok_(parallel_results[bm.name].timing.notnull().all())
+
+        # nothing is left to do on another run
+        eq_([outcome for rev, outcome in parallel.run()], [(False, 0)] * 3)
+
+    def test_run_unexpected_error(self):
+        def _copy_benchmark_scripts_and_deps():
+            raise OSError("No space left on device")
+
+        for name, n_workers in (('serial', 1), ('parallel', 2)):
+            runner = self._get_runner(name, n_workers=n_workers)
+            for bench_repo in runner.bench_repos:
+                bench_repo._copy_benchmark_scripts_and_deps = \
+                    _copy_benchmark_scripts_and_deps
+            # not a failure to build, so the revision is not blacklisted
+            assert_raises(OSError, runner.run)
+            eq_(runner.blacklist, set())
+
+    def test_run_revisions_writes_per_revision(self):
+        runner = self._get_runner('parallel', n_workers=2)
+        revisions = list(runner._get_revisions_to_run())
+        written = []
+        write_results = runner._write_results
+
+        def _write_results(rev, results):
+            written.append((rev, sorted(results)))
+            return write_results(rev, results)
+        runner._write_results = _write_results
+
+        outcomes = list(runner._run_revisions(revisions))
+        eq_([rev for rev, outcome in outcomes], revisions)
+        ok_(isinstance(outcomes[2][1], FailedToBuildError))
+        # all results of a revision are written at once, as in serial mode,
+        # and nothing for the one which failed to build
+        checksums = sorted(bm.checksum for bm in self.benchmarks)
+        eq_(sorted(written),
+            sorted((rev, [] if rev == revisions[2] else checksums)
+                   for rev in revisions))
+
+    def test_carry_forward(self):
+        source_globs = {None: ['*.py']}
+        serial = self._get_runner('serial', source_globs=source_globs)
+        parallel = self._get_runner('parallel', source_globs=source_globs,
+                                    n_workers=2)
+        revisions = list(serial._get_revisions_to_run())
+        first, doc, broken, fixed = revisions
+
+        for runner in (serial, parallel):
+            ran = runner.run()
+            # nothing needs running (or building) without changes to mod.py
+            eq_(ran, [(first, (True, 2)), (doc, (False, 0)),
+                      (broken, (False, 0)), (fixed, (True, 2))])
+            eq_(runner.blacklist, set())
+            for bm in self.benchmarks:
+                results = runner.db.get_benchmark_results(bm.checksum,
+                                                          aggregated=False)
+                eq_(list(results.revision), revisions)
+                eq_(list(results.carried_from), [None, first, doc, None])
+                eq_(results.timing[1], results.timing[0])
+
+        bm = self.benchmarks[0]
+        latest = serial.db.get_latest_results(serial.repo.timestamps[fixed])
+        eq_(latest[bm.checksum].revision, broken)
+        row = serial._carry_forward(fixed, bm, latest[bm.checksum])
+        eq_(row, None)
+        row = serial._carry_forward(broken, bm, latest[bm.checksum])
+        eq_(row['carried_from'], broken)
+        eq_(serial._carry_forward(first, bm, None), None)
@@ -29,9 +29,12 @@ __author__ = 'Yaroslav Halchenko'
 __copyright__ = 'Copyright (c) 2013 Yaroslav Halchenko'
 __license__ = 'MIT'
 
-from nose.tools import eq_, ok_
+from cStringIO import StringIO
 
-from vbench.utils import multires_order
+from nose.tools import eq_, ok_, assert_raises
+
+from vbench.utils import multires_order, confine_cmd, parse_cpus, \
+     complement_cpus, read_message, write_message
 
 def test_multires_order():
     r = [str(x) for x in range(5)]
@@ -52,3 +55,30 @@ def test_multires_order():
         if n > 2: eq_(o[2], n-1)
         if n > 8: ok_(o[3] != 1)          # we must not get to the 1st yet
         if n > 3: ok_(o[-1] in [n-2, n-3])   # end should be very close to last ones
+
+def test_confine_cmd():
+    eq_(confine_cmd('python x.py'), 'python x.py')
+    eq_(confine_cmd('python x.py', cpus='2-3'),
+        "taskset -c 2-3 sh -c 'python x.py'")
+    eq_(confine_cmd('a; b', cpus='0', nice=10),
+        "taskset -c 0 nice -n 10 sh -c 'a; b'")
+
+def test_cpus():
+    eq_(parse_cpus('0-3,8'), set([0, 1, 2, 3, 8]))
+    eq_(parse_cpus('5'), set([5]))
+    eq_(complement_cpus('0-1,3', ncpus=6), '2,4,5')
+    eq_(complement_cpus('0-3', ncpus=4), None)
+
+def test_messages():
+    stream = StringIO()
+    write_message(stream, 'ready')
+    write_message(stream, ('abc', {'timing': 1.5}))
+    write_message(stream, None)
+    stream.seek(0)
+    eq_(read_message(stream), 'ready')
+    eq_(read_message(stream), ('abc', {'timing': 1.5}))
+    eq_(read_message(stream), None)
+    assert_raises(EOFError, read_message, stream)
+    # truncated message
+    stream = StringIO(stream.getvalue()[:6])
+    assert_raises(EOFError, read_message, stream)
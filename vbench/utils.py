@@ -32,7 +32,9 @@ __license__ = 'MIT'
 from itertools import chain
 from math import ceil
 
-import importlib, sys, subprocess
+import cPickle as pickle
+import importlib, pipes, struct, sys, subprocess
+from multiprocessing import cpu_count
 
 from vbench.benchmark import Benchmark
 
@@ -109,6 +111,72 @@ def run_cmd(cmd, stderr_levels=('warn', 'error'), **kwargs):
             getattr(log, stderr_level)("stderr: " + stderr)
     return proc
 
+def confine_cmd(cmd, cpus=None, nice=None):
+    """Wrap a shell command so it runs only on the specified CPUs
+
+    cpus : str or None
+      CPU list as understood by taskset(1), e.g. '0' or '2-7,9'
+    nice : int or None
+      niceness adjustment for the command (and all of its children)
+
+    If neither is given, command is returned unchanged
+    """
+    prefix = []
+    if cpus is not None:
+        prefix.append('taskset -c %s' % cpus)
+    if nice is not None:
+        prefix.append('nice -n %d' % nice)
+    if not prefix:
+        return cmd
+    # run through a subshell so restrictions apply to compound commands
+    return '%s sh -c %s' % (' '.join(prefix), pipes.quote(cmd))
+
+def parse_cpus(cpus):
+    """Parse taskset(1)-style CPU list, e.g. '0-3,8', into a set of ints"""
+    out = set()
+    for part in cpus.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            lo, hi = part.split('-')
+            out.update(range(int(lo), int(hi) + 1))
+        else:
+            out.add(int(part))
+    return out
+
+def complement_cpus(cpus, ncpus=None):
+    """Return CPU list of all the CPUs not listed in `cpus`
+
+    Returns None if there would be none left
+    """
+    if ncpus is None:
+        ncpus = cpu_count()
+    left = sorted(set(range(ncpus)) - parse_cpus(cpus))
+    if not left:
+        return None
+    return ','.join(str(x) for x in left)
+
+def write_message(stream, obj):
+    """Write obj into the stream as a length-prefixed pickle"""
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    stream.write(struct.pack('!I', len(data)))
+    stream.write(data)
+    stream.flush()
+
+def read_message(stream):
+    """Read an object written by `write_message`
+
+    Raises EOFError if the stream got closed
+    """
+    def _read(n):
+        data = stream.read(n)
+        if len(data) != n:
+            raise EOFError("Stream closed while reading a message")
+        return data
+    size, = struct.unpack('!I', _read(4))
+    return pickle.loads(_read(size))
+
 # TODO: join two together
 def collect_benchmarks_from_object(obj):
     if isinstance(obj, Benchmark):
@@ -152,7 +220,7 @@ def verify_benchmarks(benchmarks, raise_=False):
     log.info("Verifying correct operation of benchmarks on system-wide available version of the libraries")
     passed, failed = [], []
     for bm in benchmarks:
-        result = bm.run(ncalls=1, repeat=1)
+        result = bm.run(ncalls=1, repeat=1, adaptive=False)
         if not result['succeeded']:
             log.warn("%s failed in stage %s with traceback: %s"
                      % (bm, result['stage'], result['traceback']))